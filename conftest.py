@@ -0,0 +1 @@
+# the tests import the scripts package from the repository root
@@ -6,7 +6,8 @@ from geopandas import read_file, GeoDataFrame
 from scripts.constants import RESULTS_PATH, SELECTED, LEISURE_TIME
 from scripts.analysis.variables import (get_avg_time, get_speed, get_car_compare, get_transit_time, get_walk_percent,
                                         get_avg_changes, get_walk_time, get_max_changes, get_fastest_mode,
-                                        get_valid_entries, get_majority_mode, get_min_max_cinema)
+                                        get_valid_entries, get_majority_mode, get_min_max_cinema, to_column, time_sum,
+                                        fastest_mode_column, fastest_overall_mode_column, trip_duration_column)
 
 
 # calculate derived variables and write them into new columns
@@ -18,17 +19,13 @@ def write_new_columns(df, times, filename=None):
     df['average speed'] = get_speed(df, times)
     df['average duration difference to car'] = get_car_compare(df, times)
     for t in times:
-        df[f'{t}_fastest_mode'] = df.apply(
-            lambda row: 'transit' if row['foot_duration'] > row[f'{t}_total_duration'] else 'foot', axis=1)
-        df[f'{t}_trip_duration'] = df.apply(
-            lambda row: row[f'{t}_total_duration'] if row['foot_duration'] > row[f'{t}_total_duration'] else row[
-                'foot_duration'], axis=1)
-        df[f'{t}_fastest_overall_mode'] = df.apply(
-            lambda row: row[f'{t}_fastest_mode'] if row['car_duration'] > row[f'{t}_total_duration'] else 'car', axis=1)
+        df[f'{t}_fastest_mode'] = fastest_mode_column(df, t)
+        df[f'{t}_trip_duration'] = trip_duration_column(df, t)
+        df[f'{t}_fastest_overall_mode'] = fastest_overall_mode_column(df, t)
         df[f'{t}_transit_dur'] = get_transit_time(df, t)
         df[f'{t}_walk_share'] = get_walk_percent(df, t, 'column')
-    df['average transit duration'] = df.apply(lambda row: sum([row[f'{t2}_transit_dur'] for t2 in times]), axis=1)
-    df['average walk share'] = df.apply(lambda row: sum([row[f'{t2}_walk_share'] / 3 for t2 in times]), axis=1)
+    df['average transit duration'] = to_column(time_sum(df, times, 'transit_dur'), df)
+    df['average walk share'] = to_column(time_sum(df, times, 'walk_share') / len(times), df)
     df['average changes'] = get_avg_changes(df, times)
 
     if filename is not None:
@@ -72,8 +69,7 @@ def get_variables_per_time(df, times, filename):
     col = ['index'] + time_str_arr
 
     for t in times:
-        df[f'{t}_fastest_mode'] = df.apply(
-            lambda row: 'transit' if row['foot_duration'] > row[f'{t}_total_duration'] else 'foot', axis=1)
+        df[f'{t}_fastest_mode'] = fastest_mode_column(df, t)
     new_df = DataFrame({
         'departure times': times,
         'average speed': [get_speed(df, t, True) for t in times],
@@ -273,7 +269,7 @@ def get_analysis_per_time(area, times=[15, 18, 21], path_end='15-18-21_Sat_104')
 
     dfs = []
     for t in times:
-        df[f'{t}_fastest_mode'] = df.apply(lambda row: 'transit' if row['foot_duration'] > row[f'{t}_total_duration'] else 'foot', axis=1)
+        df[f'{t}_fastest_mode'] = fastest_mode_column(df, t)
 
         if 'population' not in df.columns.values:
             print('join with pop file')
@@ -1,21 +1,41 @@
-from pandas import isnull
+from numpy import ma, where, nan
+from pandas import isnull, Series
 
 
+# get column as float array with missing values masked
+# {args} df: df, column: str
+# {returns} masked array
+def masked_column(df, column):
+    return ma.masked_invalid(df[column].to_numpy(dtype=float))
+
+
+# get masked array as column of df, masked values are nan
+# {args} values: masked array, df: df
+# {returns} series
+def to_column(values, df):
+    return Series(ma.filled(values.astype(float), nan), index=df.index)
+
+
+# get sum of a column over all times, masked if one of the times is missing
+# {args} df: df, time: [int], column: str
+# {returns} masked array
+def time_sum(df, time, column):
+    return sum(masked_column(df, f'{t}_{column}') for t in time)
+
+
+# speeds are masked for missing durations and durations of 0, masked division does not divide by them
 # {args} df: df, time: [int] or int, average: boolean
 # {returns} df or float
 def get_speed(df, time, average=False):
     if isinstance(time, list):
         for t in time:
-            df[f'{t}_speed'] = df.apply(
-                lambda row: row['distance_start_cinema'] / row[f'{t}_total_duration'] if isinstance(
-                    row[f'{t}_total_duration'], float) else 'no duration available', axis=1)
-        return df.apply(lambda row: sum([row[f'{t2}_speed'] / len(time) for t2 in time]), axis=1)
+            df[f'{t}_speed'] = get_speed(df, t)
+        return to_column(sum(masked_column(df, f'{t}_speed') / len(time) for t in time), df)
     else:
-        speed = df.apply(
-            lambda row: row['distance_start_cinema'] / row[f'{time}_total_duration'] if isinstance(
-                row[f'{time}_total_duration'], float) else 'no duration available', axis=1)
+        speed = to_column(masked_column(df, 'distance_start_cinema') / masked_column(df, f'{time}_total_duration'),
+                          df)
         if average:
-            return speed.mean(numeric_only=True)
+            return speed.mean()
         else:
             return speed
 
@@ -24,7 +44,7 @@ def get_speed(df, time, average=False):
 # {returns} df or float
 def get_avg_time(df, time):
     if isinstance(time, list):
-        return df.apply(lambda row: sum([row[f'{t}_total_duration'] for t in time]), axis=1)
+        return to_column(time_sum(df, time, 'total_duration'), df)
     elif isinstance(time, int):
         return df[f'{time}_total_duration'].mean()
 
@@ -32,10 +52,10 @@ def get_avg_time(df, time):
 # {args} df: df, time: int, average: boolean
 # {returns} float or df
 def get_transit_time(df, time, average=False):
-    transit = df.apply(lambda row: row[f'{time}_total_duration'] - (row[f'{time}_walk_to'] + row[f'{time}_walk_from']),
-                       axis=1)
+    transit = to_column(masked_column(df, f'{time}_total_duration') -
+                        (masked_column(df, f'{time}_walk_to') + masked_column(df, f'{time}_walk_from')), df)
     if average:
-        return transit.mean(numeric_only=True)
+        return transit.mean()
     else:
         return transit
 
@@ -43,9 +63,9 @@ def get_transit_time(df, time, average=False):
 # {args} df: df, time: int, average: boolean
 # {returns} float or df
 def get_walk_time(df, time, average=False):
-    walk = df.apply(lambda row: row[f'{time}_walk_to'] + row[f'{time}_walk_from'], axis=1)
+    walk = to_column(masked_column(df, f'{time}_walk_to') + masked_column(df, f'{time}_walk_from'), df)
     if average:
-        return walk.mean(numeric_only=True)
+        return walk.mean()
     else:
         return walk
 
@@ -53,8 +73,8 @@ def get_walk_time(df, time, average=False):
 # {args} df: df, time: int, result: str or int
 # {returns} df or float
 def get_walk_percent(df, time, result=None):
-    df2 = df.assign(walk=get_walk_time(df, time))
-    percent = df2.apply(lambda row: 100 / row[f'{time}_total_duration'] * row['walk'], axis=1)
+    walk = masked_column(df, f'{time}_walk_to') + masked_column(df, f'{time}_walk_from')
+    percent = to_column(100 / masked_column(df, f'{time}_total_duration') * walk, df)
 
     if result == 'column':
         return percent
@@ -65,15 +85,14 @@ def get_walk_percent(df, time, result=None):
     elif result == 'min':
         return percent.min()
     elif isinstance(result, int):
-        cutoff = list(filter(lambda item: item < result, percent.values))
-        return len(cutoff) / len(percent) if len(percent) else None
+        return (percent < result).sum() / len(percent) if len(percent) else None
 
 
 # {args} df: df, time: [int] or int
 # {returns} df or float
 def get_avg_changes(df, time):
     if isinstance(time, list):
-        return df.apply(lambda row: sum([row[f'{t}_total_changes'] for t in time]), axis=1)
+        return to_column(time_sum(df, time, 'total_changes'), df)
     else:
         return df[f'{time}_total_changes'].mean()
 
@@ -88,15 +107,38 @@ def get_max_changes(df, time):
 # {returns} df or float
 def get_car_compare(df, time, average=False):
     if isinstance(time, list):
-        return df.apply(lambda row: row['average duration'] - row['car_duration'], axis=1)
+        return to_column(masked_column(df, 'average duration') - masked_column(df, 'car_duration'), df)
     else:
-        diff = df.apply(lambda row: row[f'{time}_total_duration'] - row['car_duration'], axis=1)
+        diff = to_column(masked_column(df, f'{time}_total_duration') - masked_column(df, 'car_duration'), df)
         if average:
-            return diff.mean(numeric_only=True)
+            return diff.mean()
         else:
             return diff
 
 
+# transit is the fastest mode if walking takes longer, if a duration is missing it is walking
+# {args} df: df, time: int
+# {returns} series of 'transit' or 'foot'
+def fastest_mode_column(df, time):
+    return Series(where(df['foot_duration'] > df[f'{time}_total_duration'], 'transit', 'foot'), index=df.index)
+
+
+# car is the fastest overall mode unless transit is faster, then it is the fastest of transit and walking
+# {args} df: df, time: int
+# {returns} series of 'transit', 'foot' or 'car'
+def fastest_overall_mode_column(df, time):
+    return Series(where(df['car_duration'] > df[f'{time}_total_duration'], df[f'{time}_fastest_mode'], 'car'),
+                  index=df.index)
+
+
+# duration of the faster of transit and walking
+# {args} df: df, time: int
+# {returns} series
+def trip_duration_column(df, time):
+    return Series(where(df['foot_duration'] > df[f'{time}_total_duration'], df[f'{time}_total_duration'],
+                        df['foot_duration']), index=df.index)
+
+
 # {args} df: df, time: int, column: str
 # {returns} df or float
 def get_fastest_mode(df, time, column='fastest_mode'):
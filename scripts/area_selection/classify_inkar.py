@@ -1,17 +1,40 @@
 from os import path
-from pandas import to_numeric
+from numpy import unique
+from pandas import to_numeric, Series
+from shapely import STRtree, box
 from geopandas import read_file, GeoDataFrame
-from jenkspy import JenksNaturalBreaks
 
 from scripts.utils import transform_crs
 from scripts.constants import INKAR_PATH, RESULTS_PATH
-from scripts.get_osm_data import get_cinema
+from scripts.get_osm_data import get_cinema, get_all_cinemas, save_cinemas
+from scripts.area_selection.natural_breaks import natural_breaks
+
+
+# count cinemas in each area with one spatial join, save cinemas of each area if they changed
+# {args} gdf: geodataframe of areas (EPSG:4326), cinemas: geodataframe (EPSG:4326)
+# {returns} series of cinema counts, nan for areas without cinemas
+def count_cinemas(gdf, cinemas):
+    cinema_rows, area_rows = STRtree(gdf['geometry'].values).query(cinemas['geometry'].values,
+                                                                    predicate='intersects')
+    # cinemas on the border of two areas are counted in the first one
+    cinema_rows, first = unique(cinema_rows, return_index=True)
+    area_rows = area_rows[first]
+
+    counts = Series(area_rows).groupby(area_rows).size()
+    written = 0
+    for area_row, rows in Series(cinema_rows).groupby(area_rows):
+        cinemas_path = path.join(RESULTS_PATH, 'geo_data', 'cinemas', f'{gdf["GEN"].iloc[area_row]}_cinemas.gpkg')
+        written += save_cinemas(cinemas.iloc[rows.to_numpy()], cinemas_path)
+    print(f'{len(cinema_rows)} cinemas in {len(counts)} areas, {written} cinema files written')
+
+    return Series(counts.reindex(range(len(gdf))).to_numpy(), index=gdf.index)
 
 
 # calculate ratio of population to cinema and write into new columns
-# {args} filename: str
+# with bulk, all cinemas are read at once and assigned to the areas, else they are requested area by area
+# {args} filename: str, bulk: boolean
 # {returns} geodataframe, overwrites given file
-def population_per_cinema(filename):
+def population_per_cinema(filename, bulk=True):
     gdf = read_file(path.join(INKAR_PATH, filename))
     label = 'population'
     column = 'Bevölkerung'
@@ -20,30 +43,30 @@ def population_per_cinema(filename):
         cinemas_path = path.join(RESULTS_PATH, 'geo_data', 'cinemas', f'{row["GEN"]}_cinemas.gpkg')
         if not path.isfile(cinemas_path):
             cinemas = get_cinema(row['geometry'])
+            if cinemas is not None:
+                cinemas.to_file(cinemas_path)
         else:
             cinemas = read_file(cinemas_path)
             print('read cinemas')
         if cinemas is None:
             return None
         else:
-            cinemas.to_file(cinemas_path)
             return len(cinemas)
 
-    def per_cinema(row):
-        cin = row['OSM_cinemas']
-        if cin is None or cin == 0 or row['Kinos'] is None:
-            return None
-        elif abs(row['cinemas_accuracy']) > 1:
-            print(f'OSM {cin} does not match INKAR {row["Kinos"]} for {row["GEN"]}')
-            return None
-        else:
-            print('matched!')
-            return row[column]/cin
-
     gdf['geometry'] = transform_crs(gdf['geometry'], 25832)
-    gdf['OSM_cinemas'] = gdf.apply(lambda row: get_cinemas(row), axis=1)
-    gdf['cinemas_accuracy'] = gdf.apply(lambda row: row['OSM_cinemas']-row['Kinos'], axis=1)
-    gdf[f'{label}_per_cinema'] = gdf.apply(lambda row: per_cinema(row), axis=1)
+    if bulk:
+        gdf['OSM_cinemas'] = count_cinemas(gdf, get_all_cinemas(box(*gdf.total_bounds)))
+    else:
+        gdf['OSM_cinemas'] = gdf.apply(lambda row: get_cinemas(row), axis=1)
+    cin = to_numeric(gdf['OSM_cinemas'])
+    gdf['cinemas_accuracy'] = cin - to_numeric(gdf['Kinos'])
+
+    # areas whose cinemas in osm do not match the number of cinemas in inkar get no ratio
+    matched = (cin > 0) & gdf['Kinos'].notna() & (gdf['cinemas_accuracy'].abs() <= 1)
+    for _, row in gdf[(cin > 0) & gdf['Kinos'].notna() & ~matched].iterrows():
+        print(f'OSM {row["OSM_cinemas"]} does not match INKAR {row["Kinos"]} for {row["GEN"]}')
+    print(f'matched {matched.sum()} areas')
+    gdf[f'{label}_per_cinema'] = (to_numeric(gdf[column]) / cin).where(matched)
     print('reprojecting...')
     gdf['geometry'] = transform_crs(gdf['geometry'], 4326, 25832)
 
@@ -52,17 +75,17 @@ def population_per_cinema(filename):
 
 
 # sort given column into groups and create new column with group assignment labels
-# {args} filename: str, column: str, new_column: str, group_number: int
+# with a sample_size, the breaks of larger columns are found on a random sample of that size
+# {args} filename: str, column: str, new_column: str, group_number: int, sample_size: int or None
 # {returns} geodataframe, overwrites given file
-def sort_by(filename, column, new_column, group_number):
+def sort_by(filename, column, new_column, group_number, sample_size=None):
     gdf = read_file(path.join(INKAR_PATH, filename))
 
     filtered = gdf[gdf[column].notna()]
     indicator = to_numeric(filtered[column], errors='coerce').dropna()
-    # sort column values into groups, write array of group assignment of each row to assigned
-    jnb = JenksNaturalBreaks(group_number)
-    jnb.fit(indicator)
-    assigned = jnb.labels_
+    # sort column values into jenks natural breaks, write array of group assignment of each row to assigned
+    assigned, breaks, _ = natural_breaks(indicator, group_number, sample_size)
+    print(f'breaks: {breaks}')
 
     print('insert classification...')
     filtered.insert(len(filtered.columns), new_column, assigned.tolist())
@@ -0,0 +1,107 @@
+from numpy import asarray, sort, unique, concatenate, cumsum, full, zeros, arange, argmin, searchsorted, inf, int64
+from numpy.random import default_rng
+
+
+# sum of squared deviations from the mean of the sorted values first to last, from the prefix sums of the values
+# {args} sums: array, squares: array, first: int or array, last: int or array
+# {returns} float or array
+def within_class_ssd(sums, squares, first, last):
+    count = last - first + 1
+    total = sums[last + 1] - sums[first]
+    return squares[last + 1] - squares[first] - total * total / count
+
+
+# find the optimal jenks natural breaks with the dynamic programming of Ckmeans.1d.dp
+# the classes minimise the sum of squared deviations from the class means like JenksNaturalBreaks, the best first
+# value of the last class only moves right with its last value, so each row of the table is filled by divide and
+# conquer in O(n log n) instead of O(n^2)
+# {args} values: array-like, group_number: int
+# {returns} list of breaks [minimum, maximum of class 1, ..., maximum of class group_number] like jenkspy
+def ckmeans_breaks(values, group_number):
+    x = sort(asarray(values, dtype=float))
+    size = len(x)
+    if group_number < 2 or group_number > size:
+        raise ValueError(f'group_number has to be between 2 and the number of values ({size})')
+
+    # values are shifted by their median, so the prefix sums lose less precision
+    shifted = x - x[size // 2]
+    sums = concatenate([zeros(1), cumsum(shifted)])
+    squares = concatenate([zeros(1), cumsum(shifted * shifted)])
+
+    # cost[i]: smallest sum of squared deviations of the values 0..i in the classes so far
+    # first[k, i]: first value of class k if value i is the last value of class k
+    cost = within_class_ssd(sums, squares, 0, arange(size))
+    first = zeros((group_number, size), dtype=int64)
+    for group in range(1, group_number):
+        new_cost = full(size, inf)
+        # ranges of last values [low, high] with the first values of the class in [first_low, first_high]
+        ranges = [(group, size - 1, group, size - 1)]
+        while ranges:
+            low, high, first_low, first_high = ranges.pop()
+            if low > high:
+                continue
+            mid = (low + high) // 2
+            candidates = arange(max(first_low, group), min(first_high, mid) + 1)
+            costs = cost[candidates - 1] + within_class_ssd(sums, squares, candidates, mid)
+            best = argmin(costs)
+            new_cost[mid] = costs[best]
+            first[group, mid] = candidates[best]
+            ranges.append((low, mid - 1, first_low, candidates[best]))
+            ranges.append((mid + 1, high, candidates[best], first_high))
+        cost = new_cost
+
+    # follow the first values of the classes back from the last value
+    breaks = [x[-1]]
+    last = size - 1
+    for group in range(group_number - 1, 0, -1):
+        last = first[group, last] - 1
+        breaks.append(x[last])
+    breaks.append(x[0])
+
+    return [float(value) for value in breaks[::-1]]
+
+
+# assign values to the classes of breaks, a value equal to a break belongs to the lower class like in jenkspy
+# {args} values: array-like, breaks: list
+# {returns} array of labels from 0 to len(breaks) - 2
+def break_labels(values, breaks):
+    return searchsorted(asarray(breaks[1:-1], dtype=float), asarray(values, dtype=float), side='left')
+
+
+# get goodness of variance fit of a classification, 1 - within class deviations / deviations from the mean
+# {args} values: array-like, labels: array
+# {returns} float between 0 and 1
+def goodness_of_variance_fit(values, labels):
+    x = asarray(values, dtype=float)
+    total = ((x - x.mean()) ** 2).sum()
+    if total == 0:
+        return 1.0
+
+    within = 0
+    for label in unique(labels):
+        group = x[labels == label]
+        within += ((group - group.mean()) ** 2).sum()
+
+    return float(1 - within / total)
+
+
+# classify values into natural breaks, exactly or with breaks found on a random sample of the values
+# the sampled breaks are stretched to the minimum and maximum of all values, the fit is reported for all values
+# {args} values: array-like, group_number: int, sample_size: int or None, seed: int
+# {returns} list [labels: array, breaks: list, goodness of variance fit: float]
+def natural_breaks(values, group_number, sample_size=None, seed=None):
+    x = asarray(values, dtype=float)
+    if sample_size is None or len(x) <= sample_size:
+        breaks = ckmeans_breaks(x, group_number)
+    else:
+        sample = default_rng(seed).choice(x, sample_size, replace=False)
+        breaks = ckmeans_breaks(sample, group_number)
+        breaks[0] = float(x.min())
+        breaks[-1] = float(x.max())
+
+    labels = break_labels(x, breaks)
+    fit = goodness_of_variance_fit(x, labels)
+    print(f'goodness of variance fit: {fit:.4f}' + (f' (breaks of {sample_size} sampled values)'
+                                                      if sample_size is not None and len(x) > sample_size else ''))
+
+    return [labels, breaks, fit]
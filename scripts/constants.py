@@ -16,6 +16,9 @@ EXTRACTED_NAME = ['Heidelberg', 'Halle-Saale', 'Osnabrück', 'Aachen',
                   'Kandern', 'Kühlungsborn', 'Seefeld', 'Ankum']
 EXTRACTED_CHANGED = {'Halle (Saale)': 1, 'Landau in der Pfalz': 4, 'Bad Soden am Taunus': 5,
                      'Aue-Bad Schlema': 6, 'Alfeld (Leine)': 7}
+# names shared by several municipalities, position of the one studied here among the areas of that name in VG5000
+# (there are two seefelds, the second one is the area studied here)
+AMBIGUOUS_AREAS = {'Seefeld': 1}
 
 # in seconds
 LEISURE_TIME = {'typical': {'women': 6840, 'men': 6300,
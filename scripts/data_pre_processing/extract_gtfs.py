@@ -0,0 +1,181 @@
+from os import path, makedirs, replace, getpid
+from io import TextIOWrapper
+from shutil import rmtree
+from zipfile import ZipFile
+from numpy import arange, repeat, cumsum, bincount, concatenate, zeros, unique, int64
+from pandas import read_csv, to_numeric, Index
+from shapely import STRtree, points
+
+from scripts.utils import admin_area, get_polygon_bbox
+from scripts.constants import SELECTED, EXTRACTED_NAME, EXTRACTED_CHANGED
+from scripts.data_pre_processing.format_gtfs import clean_gtfs_chunk, CLEANED_FILES, CHUNK_ROWS
+from scripts.routing.timetable_cache import clear_timetable_cache
+
+GTFS_PATH = path.join('data', 'gtfs_files')
+# tables written into the extracted feeds, other tables of the full feed are not used by the routing
+EXTRACTED_TABLES = ['agency', 'routes', 'trips', 'stops', 'stop_times', 'calendar', 'calendar_dates', 'feed_info']
+
+
+# get bounding boxes of areas and the names their extracted feeds are saved with
+# gtfs_general commands did not take spaces or brackets, the changed filenames are kept for the extracted feeds
+# {args} area_names: [str], full_gtfs: str
+# {returns} dict of filtered filename: bbox polygon (EPSG:4326)
+def area_boxes(area_names, full_gtfs):
+    boxes = {}
+    for area_name in area_names:
+        name = EXTRACTED_NAME[EXTRACTED_CHANGED[area_name]] if area_name in EXTRACTED_CHANGED else area_name
+        filtered = f'{name}_{full_gtfs}_filtered'
+        if path.isfile(path.join(GTFS_PATH, f'{filtered}.zip')):
+            print(f'{filtered} exists')
+            continue
+        boxes[filtered] = get_polygon_bbox(admin_area(area_name)['geometry'].iloc[0], 25832)
+
+    return boxes
+
+
+# assign stops to all bounding boxes containing them with a spatial index of the boxes
+# {args} stops: df of gtfs stops, boxes: [polygon]
+# {returns} list of arrays [indptr, areas], the boxes of stop i are areas[indptr[i]:indptr[i+1]]
+def assign_stops(stops, boxes):
+    stop_points = points(to_numeric(stops['stop_lon']).to_numpy(), to_numeric(stops['stop_lat']).to_numpy())
+    stop_rows, areas = STRtree(boxes).query(stop_points, predicate='intersects')
+
+    order = stop_rows.argsort(kind='stable')
+    indptr = concatenate([zeros(1, dtype=int64), cumsum(bincount(stop_rows, minlength=len(stops)))])
+
+    return [indptr, areas[order]]
+
+
+# read stop_times of the full feed once and append the rows at stops in each box to a part file of the box
+# {args} zip_ref: ZipFile, stop_ids: Index, stop_areas: [indptr, areas], part_files: [str]
+# {returns} None, writes csv part files
+def split_stop_times(zip_ref, stop_ids, stop_areas, part_files):
+    indptr, areas = stop_areas
+    counts = indptr[1:] - indptr[:-1]
+    with zip_ref.open('stop_times.txt') as table_file:
+        for cid, chunk in enumerate(read_csv(table_file, dtype=str, keep_default_na=False, na_values=[''],
+                                             chunksize=CHUNK_ROWS)):
+            print(f'reading stop_times rows {cid * CHUNK_ROWS}-{(cid + 1) * CHUNK_ROWS}...')
+            stop_rows = stop_ids.get_indexer(chunk['stop_id'])
+            # stops missing in stops.txt are in no box
+            row_counts = counts[stop_rows.clip(0)] * (stop_rows >= 0)
+
+            # one row per stop time and box containing its stop
+            rows = repeat(arange(len(chunk)), row_counts)
+            offsets = arange(len(rows)) - repeat(cumsum(row_counts) - row_counts, row_counts)
+            row_areas = areas[repeat(indptr[stop_rows.clip(0)], row_counts) + offsets]
+
+            # rows sorted by box, so each part file gets one slice of the chunk
+            order = row_areas.argsort(kind='stable')
+            rows, row_areas = rows[order], row_areas[order]
+            chunk_areas, first = unique(row_areas, return_index=True)
+            for area, start, end in zip(chunk_areas, first, concatenate([first[1:], [len(rows)]])):
+                with open(part_files[area], 'a', encoding='utf-8', newline='') as part:
+                    chunk.iloc[rows[start:end]].to_csv(part, index=False, header=part.tell() == 0)
+
+
+# keep trips with at least two stops in the box and number their stops from 0 like the gtfs_general extracts
+# {args} stop_times: df of strings
+# {returns} dataframe
+def cut_trips(stop_times):
+    stop_times = stop_times.assign(sequence=to_numeric(stop_times['stop_sequence']))
+    stop_times = stop_times.sort_values(['trip_id', 'sequence'], kind='stable')
+    stop_times = stop_times[stop_times.groupby('trip_id')['trip_id'].transform('size') > 1]
+    stop_times['stop_sequence'] = stop_times.groupby('trip_id').cumcount().astype(str)
+
+    return stop_times.drop(columns='sequence')
+
+
+# write a table into an entry of the zip archive, na values of the cleaned files are replaced like in format_gtfs
+# {args} df: df of strings, file: str, zipf: ZipFile
+# {returns} None, writes zip entry
+def write_table(df, file, zipf):
+    if file in CLEANED_FILES:
+        df = clean_gtfs_chunk(df.copy(), file)
+    with TextIOWrapper(zipf.open(file, 'w'), encoding='utf-8', newline='') as entry:
+        df.to_csv(entry, index=False)
+
+
+# write the feed of one box from its stop_times part file and the small tables of the full feed
+# {args} filtered: str, part_file: str, tables: dict of table name: df of strings
+# {returns} None, creates zip archive
+def write_area_feed(filtered, part_file, tables):
+    output_zip = path.join(GTFS_PATH, f'{filtered}.zip')
+    if not path.isfile(part_file):
+        print(f'{filtered} contains no stops')
+        return
+
+    stop_times = cut_trips(read_csv(part_file, dtype=str, keep_default_na=False, na_values=['']))
+    area = {'stop_times': stop_times}
+    area['trips'] = tables['trips'][tables['trips']['trip_id'].isin(stop_times['trip_id'])]
+    area['routes'] = tables['routes'][tables['routes']['route_id'].isin(area['trips']['route_id'])]
+    stops = tables['stops'][tables['stops']['stop_id'].isin(stop_times['stop_id'])]
+    if 'parent_station' in stops.columns:
+        # parent stations are kept with their stops
+        stops = tables['stops'][tables['stops']['stop_id'].isin(stop_times['stop_id']) |
+                                tables['stops']['stop_id'].isin(stops['parent_station'])]
+    area['stops'] = stops
+    for table in ['calendar', 'calendar_dates']:
+        if table in tables:
+            area[table] = tables[table][tables[table]['service_id'].isin(area['trips']['service_id'])]
+    if 'agency' in tables:
+        agency = tables['agency']
+        area['agency'] = agency[agency['agency_id'].isin(area['routes']['agency_id'])] \
+            if 'agency_id' in agency.columns and 'agency_id' in area['routes'].columns else agency
+    if 'feed_info' in tables:
+        area['feed_info'] = tables['feed_info']
+
+    # write to temporary file first, so a routing process never reads a half written feed
+    tmp_zip = f'{output_zip}.{getpid()}.tmp'
+    with ZipFile(tmp_zip, 'w') as zipf:
+        for table, df in area.items():
+            write_table(df, f'{table}.txt', zipf)
+    replace(tmp_zip, output_zip)
+    # timetables prepared from the previous version of the feed are outdated
+    clear_timetable_cache(output_zip)
+    print(f'{filtered}: {len(area["stops"])} stops, {len(area["trips"])} trips')
+
+
+# extract the feeds of all areas from the full feed in one pass over its stop_times
+# stops are assigned to the bounding boxes of all areas at once, the stop times of each box are collected in a part
+# file and every box gets a filtered feed like the ones of gtfs_general and format_gtfs
+# {args} area_names: [str], full_gtfs: str
+# {returns} None, creates zip archives
+def extract_areas(area_names, full_gtfs):
+    boxes = area_boxes(area_names, full_gtfs)
+    if not boxes:
+        return
+    names = list(boxes)
+
+    part_folder = path.join(GTFS_PATH, f'{full_gtfs}_parts.{getpid()}.tmp')
+    makedirs(part_folder, exist_ok=True)
+    part_files = [path.join(part_folder, f'{aid}.csv') for aid in range(len(names))]
+    try:
+        with ZipFile(path.join(GTFS_PATH, f'{full_gtfs}.zip'), 'r') as zip_ref:
+            files = zip_ref.namelist()
+            tables = {}
+            for table in EXTRACTED_TABLES:
+                if table != 'stop_times' and f'{table}.txt' in files:
+                    with zip_ref.open(f'{table}.txt') as table_file:
+                        tables[table] = read_csv(table_file, dtype=str, keep_default_na=False, na_values=[''])
+
+            stop_areas = assign_stops(tables['stops'], [boxes[name] for name in names])
+            split_stop_times(zip_ref, Index(tables['stops']['stop_id']), stop_areas, part_files)
+
+        for name, part_file in zip(names, part_files):
+            write_area_feed(name, part_file, tables)
+    finally:
+        rmtree(part_folder, ignore_errors=True)
+
+
+# extract the feeds of all selected areas of all levels in one pass
+# {args} full_gtfs: str, levels: [str]
+# {returns} None, creates zip archives
+def extract_selected(full_gtfs, levels=('top', 'mid', 'base')):
+    extract_areas([name for level in levels for name in SELECTED[level]], full_gtfs)
+    print('finished extracting all selected')
+
+
+if __name__ == "__main__":
+    gtfs_filename = 'opnv_240218'
+    extract_selected(gtfs_filename)
@@ -1,31 +1,78 @@
-from os import path, listdir
+from os import path, walk, replace, getpid
+from io import TextIOWrapper
+from shutil import copyfileobj
+from zipfile import ZipFile
 from pandas import read_csv
 
-from scripts.utils import create_zip, remove_dir
+from scripts.utils import remove_dir, GTFS_TIME_COLUMNS
 from scripts.constants import SELECTED, EXTRACTED_NAME, EXTRACTED_CHANGED
+from scripts.routing.timetable_cache import clear_timetable_cache
+
+# gtfs files whose na values are replaced, other files of a feed are copied unchanged
+CLEANED_FILES = ('stops.txt', 'stop_times.txt', 'trips.txt', 'routes.txt', 'calendar.txt', 'calendar_dates.txt')
+# columns written as integers, they are floats in the extracted feeds if they contain na values
+INT_COLUMNS = {'stops.txt': ['location_type'], 'stop_times.txt': ['pickup_type', 'drop_off_type']}
+# columns whose empty values mean missing values, they are kept empty: stops between timepoints have no times and
+# a stop without parent station would get the parent '0'
+MISSING_COLUMNS = {'stop_times.txt': GTFS_TIME_COLUMNS + ['shape_dist_traveled'], 'stops.txt': ['parent_station']}
+# number of rows of a gtfs file cleaned at a time, so memory use does not grow with the size of the feed
+CHUNK_ROWS = 500000
+
+
+# replace na values with 0 and 'no value' for missing stop headsigns, write integer columns as integers
+# na values of MISSING_COLUMNS are kept
+# {args} chunk: df of strings, file: str
+# {returns} dataframe
+def clean_gtfs_chunk(chunk, file):
+    if file == 'stop_times.txt' and 'stop_headsign' in chunk.columns:
+        chunk['stop_headsign'] = chunk['stop_headsign'].fillna('no value')
+    filled = [column for column in chunk.columns if column not in MISSING_COLUMNS.get(file, [])]
+    chunk[filled] = chunk[filled].fillna('0')
+
+    for column in INT_COLUMNS.get(file, []):
+        if column in chunk.columns:
+            chunk[column] = chunk[column].astype(float).astype(int)
+
+    return chunk
+
+
+# read a gtfs file in chunks, clean them and write them straight into an entry of the zip archive
+# {args} table_file: file object, file: str, zipf: ZipFile
+# {returns} None, writes zip entry
+def write_cleaned_file(table_file, file, zipf):
+    with TextIOWrapper(zipf.open(file, 'w'), encoding='utf-8', newline='') as entry:
+        # all columns are read as strings, so values are written back as they were read
+        for cid, chunk in enumerate(read_csv(table_file, dtype=str, chunksize=CHUNK_ROWS)):
+            clean_gtfs_chunk(chunk, file).to_csv(entry, index=False, header=cid == 0)
 
 
 # replace na values with 0, assign value types to columns and save gtfs txt files in zip archive
+# the files are streamed chunk by chunk from the extracted folder into the zip archive
 # {args} gtfs: str, level: str, unzipped: boolean
 # {returns} None, creates zip archives
 def filter_gtfs_na(gtfs):
     output_path = path.join('data', 'gtfs_files', gtfs)
+    # the filtered feed is written next to the extracted folder, where its timetable cache folder is as well
+    output_zip = path.join('data', 'gtfs_files', f'{gtfs}_filtered.zip')
 
-    file_names = ('stops.txt', 'stop_times.txt', 'trips.txt', 'routes.txt', 'calendar.txt', 'calendar_dates.txt')
-
-    for fid, file in enumerate(file_names):
-        if file in listdir(output_path):
-            df = read_csv(path.join(output_path, file))
-            int_df = df.fillna(0)
-            if fid == 0:
-                int_df = int_df.astype({'location_type': 'int'})
-            elif fid == 1:
-                int_df['stop_headsign'] = df['stop_headsign'].apply(lambda x: 'no value' if x == 0 else x)
-                int_df = int_df.astype({'stop_headsign': 'str', 'pickup_type': 'int', 'drop_off_type': 'int'})
+    # write to temporary file first, so a routing process never reads a half written feed
+    tmp_zip = f'{output_zip}.{getpid()}.tmp'
+    with ZipFile(tmp_zip, 'w') as zipf:
+        for root, _, files in walk(output_path):
+            for file in files:
+                file_path = path.join(root, file)
+                entry_name = path.relpath(file_path, output_path)
+                if entry_name in CLEANED_FILES:
+                    with open(file_path, 'rb') as table_file:
+                        write_cleaned_file(table_file, entry_name, zipf)
+                else:
+                    with open(file_path, 'rb') as source, zipf.open(entry_name, 'w') as entry:
+                        copyfileobj(source, entry)
+    replace(tmp_zip, output_zip)
 
-            int_df.to_csv(path.join(output_path, file_names[fid]), index=False)
-    create_zip(output_path, f'{gtfs}_filtered.zip')
     remove_dir(output_path)
+    # timetables prepared from the previous version of the feed are outdated
+    clear_timetable_cache(output_zip)
 
 
 # filter extracted gtfs feeds for all selected areas
@@ -1,12 +1,21 @@
-from os import path
-from shapely import geometry, Point, LineString
+from os import path, replace, getpid
+from shapely import geometry, Point, LineString, from_wkb, to_wkb
 from osmnx import features
-from pandas import notna
+from numpy import asarray, column_stack, unique
+from scipy.spatial import cKDTree
+from pandas import notna, factorize
 from geopandas import read_file, GeoDataFrame
 
-from scripts.utils import transform_crs, germany_admin
+from scripts.utils import transform_crs, admin_area, get_transformer
 from scripts.constants import RESULTS_PATH
 
+# nearest stop indices of the gtfs feeds used in this process, keyed by id of the stops df
+STOP_INDICES = {}
+# osm extract of the whole country, all cinemas are read from it if it exists
+COUNTRY_PBF = path.join('osm_files', 'germany-latest.osm.pbf')
+# cinemas of the whole country, read from COUNTRY_PBF or downloaded once
+ALL_CINEMAS_PATH = path.join(RESULTS_PATH, 'geo_data', 'cinemas', 'all_cinemas.gpkg')
+
 
 # request cinemas
 # {args} area: shapely polygon
@@ -18,12 +27,7 @@ def get_cinema(area):
         if cinemas.empty:
             raise ValueError('Dataframe is empty')
 
-        for rid, row in cinemas.iterrows():
-            if type(row['geometry']) is geometry.polygon.Polygon:
-                pg = transform_crs(row['geometry'], 4326, 25832, True)
-                pt = pg.centroid
-                cinemas.at[rid, 'geometry'] = transform_crs(pt, 25832, 4326, True)
-
+        cinemas = cinema_centroids(cinemas)
         if 'name' in cinemas.columns:
             if 'amenity' in cinemas.columns:
                 return cinemas[['geometry', 'name', 'amenity']]
@@ -38,6 +42,90 @@ def get_cinema(area):
         return None
 
 
+# replace polygons of cinemas by their centroids, calculated in metric coordinates
+# {args} cinemas: geodataframe (EPSG:4326)
+# {returns} geodataframe
+def cinema_centroids(cinemas):
+    polygons = cinemas['geometry'].apply(lambda geo: type(geo) is geometry.polygon.Polygon)
+    if polygons.any():
+        centroids = transform_crs(cinemas.loc[polygons, 'geometry'], 4326, 25832).apply(lambda pg: pg.centroid)
+        cinemas.loc[polygons, 'geometry'] = transform_crs(centroids, 25832, 4326)
+
+    return cinemas
+
+
+# read all cinemas of an osm extract, cinemas mapped as buildings are assembled to areas
+# {args} pbf_file: str
+# {returns} geodataframe containing cinemas
+def cinemas_from_pbf(pbf_file):
+    # osmium is only needed to read the country extract, routing reads the saved cinemas without it
+    import osmium
+
+    is_cinema = osmium.filter.TagFilter(('amenity', 'cinema'))
+    wkb_factory = osmium.geom.WKBFactory()
+    names = []
+    geometries = []
+    for obj in osmium.FileProcessor(pbf_file).with_areas(is_cinema).with_filter(is_cinema):
+        if obj.is_node():
+            geom = Point(obj.location.lon, obj.location.lat)
+        elif obj.is_area():
+            geom = from_wkb(wkb_factory.create_multipolygon(obj))
+            # most buildings are a single polygon, so they are replaced by their centroid like in get_cinema
+            if len(geom.geoms) == 1:
+                geom = geom.geoms[0]
+        else:
+            # closed ways and multipolygon relations are returned as areas as well
+            continue
+        names.append(obj.tags.get('name'))
+        geometries.append(geom)
+
+    cinemas = GeoDataFrame({'name': names, 'amenity': 'cinema', 'geometry': geometries}, geometry='geometry',
+                           crs=4326)
+    return cinema_centroids(cinemas)
+
+
+# get all cinemas of the country at once, from the country extract if it exists or with one download for the area
+# the cinemas are saved and read from file until the country extract changes
+# {args} area: shapely polygon (EPSG:4326) containing all areas, only used for the download
+# {returns} geodataframe containing cinemas
+def get_all_cinemas(area=None):
+    pbf_file = COUNTRY_PBF if path.isfile(COUNTRY_PBF) else None
+    if path.isfile(ALL_CINEMAS_PATH) and \
+            (pbf_file is None or path.getmtime(ALL_CINEMAS_PATH) >= path.getmtime(pbf_file)):
+        return read_file(ALL_CINEMAS_PATH)
+
+    if pbf_file is not None:
+        print(f'reading cinemas from {pbf_file}...')
+        cinemas = cinemas_from_pbf(pbf_file)
+    elif area is not None:
+        print('downloading cinemas...')
+        cinemas = get_cinema(area)
+        if cinemas is None:
+            raise Exception('no cinemas found in given area')
+        cinemas = cinemas.reset_index(drop=True)
+    else:
+        raise Exception(f'{COUNTRY_PBF} does not exist and no area to download cinemas for was given')
+
+    # gpkg files need their extension, the temporary file keeps it
+    tmp_file = f'{ALL_CINEMAS_PATH[:-5]}.{getpid()}.tmp.gpkg'
+    cinemas.to_file(tmp_file)
+    replace(tmp_file, ALL_CINEMAS_PATH)
+    return cinemas
+
+
+# save cinemas of an area, the file is only written if the cinemas differ from the saved ones
+# {args} cinemas: geodataframe, cinemas_path: str
+# {returns} boolean, True if the file was written
+def save_cinemas(cinemas, cinemas_path):
+    if path.isfile(cinemas_path):
+        saved = read_file(cinemas_path)
+        if sorted(to_wkb(saved['geometry'].values, hex=True)) == sorted(to_wkb(cinemas['geometry'].values, hex=True)):
+            return False
+
+    cinemas.to_file(cinemas_path)
+    return True
+
+
 # get random selection of features as list
 # {args} feat: series or list, number: int, seed: int
 # {returns} list of pois
@@ -53,15 +141,8 @@ def random_features(feat, number, seed=None):
 # {args} area_name: string, start_count: int
 # {returns} geodataframe
 def get_random_start(area_name, start_count):
-    districts = germany_admin('GEM')
     # get polygon of area
-    area = districts[districts['GEN'] == area_name]
-
-    # there are two seefelds, the second one is the area studied here
-    if area_name == 'Seefeld':
-        area_polygon = area.geometry.iloc[1]
-    else:
-        area_polygon = area.geometry.iloc[0]
+    area_polygon = admin_area(area_name).geometry.iloc[0]
 
     area_pg_wgs84 = transform_crs(area_polygon, 25832, 4326, True)
 
@@ -112,10 +193,8 @@ def get_random_start(area_name, start_count):
 # {args} area_name: string
 # {returns} geodataframe
 def bbox_edge_coords(area_name):
-    districts = germany_admin('GEM')
     # get polygon of area
-    area = districts[districts['GEN'] == area_name]
-    area_polygon = area.geometry.iloc[0]
+    area_polygon = admin_area(area_name).geometry.iloc[0]
     bbox = transform_crs(area_polygon.envelope, 25832, 4326, True)
 
     filepath = path.join(RESULTS_PATH, 'geo_data', f'residential_{area_name}.gpkg')
@@ -160,36 +239,61 @@ def is_point_object(arg):
         raise TypeError('is not Point, tuple or list object')
 
 
-# get the closest stations for one point as a GeoDataFrame
-# {args} gtfs_name: str/df, point: Point, number: int, gtfs_zipped: boolean
-# {returns} dataframe
-def get_stations(gtfs_df, point, number=10):
+# build the nearest stop index of a gtfs feed once, a kd-tree over the projected stop coordinates
+# {args} gtfs_df: dict of dfs
+# {returns} dict
+def stop_index(gtfs_df):
     stops = gtfs_df['stops']
-    point = is_point_object(point)
+    # the index keeps a reference to the stops df, so its id is not reused while the index exists
+    if id(stops) not in STOP_INDICES or STOP_INDICES[id(stops)]['stops'] is not stops:
+        x, y = get_transformer(4326, 25832).transform(stops['stop_lon'].to_numpy(),
+                                                      stops['stop_lat'].to_numpy())
+        STOP_INDICES[id(stops)] = {'stops': stops, 'tree': cKDTree(column_stack([x, y])),
+                                   'names': factorize(stops['stop_name'])[0]}
+
+    return STOP_INDICES[id(stops)]
+
+
+# get the closest stations with distinct names for many points with one query of the stop index
+# {args} gtfs_df: dict of dfs, points: [Point], number: int
+# {returns} list of dataframes, one per point, with the distance to the point in metres
+def get_nearest_stations(gtfs_df, points, number=10):
+    index = stop_index(gtfs_df)
+    stop_count = len(index['stops'])
+    x, y = get_transformer(4326, 25832).transform([point.x for point in points],
+                                                  [point.y for point in points])
+    coords = column_stack([x, y])
 
-    # calculate distance from point to all stops in gtfs data
-    stops['distance'] = stops.apply(
-        lambda row: point.distance(Point(row['stop_lon'], row['stop_lat'])),
-        axis=1
-    )
-    # sort stops by ascending distance and delete duplicate names
-    sorted_stops = stops.sort_values('distance')
-    unique_stops = sorted_stops[~sorted_stops.duplicated('stop_name')]
+    stations = []
+    k = min(number * 4, stop_count)
+    distances, positions = index['tree'].query(coords, k)
+    for pid in range(len(points)):
+        dist, pos = asarray(distances[pid]).reshape(-1), asarray(positions[pid]).reshape(-1)
+        # several stops share a name, ask for more neighbours until there are enough distinct names
+        query_k = k
+        while len(unique(index['names'][pos])) < number and query_k < stop_count:
+            query_k = min(query_k * 4, stop_count)
+            dist, pos = index['tree'].query(coords[pid], query_k)
+        # keep the closest stop of each name
+        first = unique(index['names'][pos], return_index=True)[1]
+        first.sort()
+        closest = index['stops'].iloc[pos[first[:number]]].copy()
+        closest['distance'] = dist[first[:number]]
+        stations.append(closest)
+
+    return stations
 
-    # return stops with the shortest distance to point
-    return unique_stops.head(number)
+
+# get the closest stations for one point as a GeoDataFrame
+# {args} gtfs_df: dict of dfs, point: Point, number: int
+# {returns} dataframe
+def get_stations(gtfs_df, point, number=10):
+    return get_nearest_stations(gtfs_df, [is_point_object(point)], number)[0]
 
 
 # get the closest stations for all POIs as list of GeoDataFrame
-# {args} gtfs_name: str/df, pois: df, number: int, gtfs_zipped: boolean
+# {args} gtfs_name: dict of dfs, pois: df, number: int
 # {returns} dict
 def get_all_stations(gtfs_name, pois, number=10):  # point: [lat, lon] shapely point
-    stations = []
-    poi_names = []
-    poi_locations = []
-    for pid, poi in pois.iterrows():
-        stations.append(get_stations(gtfs_name, poi['geometry'], number))
-        poi_names.append(poi['name'])
-        poi_locations.append(poi['geometry'])
-
-    return {'stations': stations, 'cinema_name': poi_names, 'cinema_location': poi_locations}
+    return {'stations': get_nearest_stations(gtfs_name, list(pois['geometry']), number),
+            'cinema_name': list(pois['name']), 'cinema_location': list(pois['geometry'])}
@@ -1,60 +1,128 @@
 from os import path
-from pandas import concat, Timedelta
+from math import ceil
+from itertools import repeat
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pandas import concat, Timedelta, DataFrame
 from geopandas import GeoSeries, GeoDataFrame, read_file
 
-from scripts.utils import germany_admin, centroid_from_name, zip_to_df, calc_distance
+from scripts.utils import admin_area, centroid_from_name, zip_to_df, calc_distance_matrix
 from scripts.constants import RESULTS_PATH, EXTRACTED_CHANGED, EXTRACTED_NAME
 from scripts.get_osm_data import get_cinema, get_all_stations, get_stations
 from scripts.routing.gtfs_routing import get_fastest_route
-from scripts.routing.ors_routing import get_all_ors_durations
+from scripts.routing.ors_routing import get_all_ors_durations_many, get_walks_to_stations, get_walks_from_stations
+from scripts.routing.duration_cache import print_cache_stats, write_used_times
+
+# number of chunks of start points per worker, more chunks balance the work better but pickle the area data more often
+CHUNKS_PER_WORKER = 4
+
+
+# create the pool of processes routing start points, created once per area and reused for all its start points
+# spawn fresh interpreters, so every worker prepares its own timetable and starts its own R session once
+# {args} workers: int
+# {returns} ProcessPoolExecutor, or a context giving None if start points are routed in this process
+def routing_pool(workers):
+    if workers > 1:
+        return ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+    return nullcontext()
+
+
+# number of start points sent to a worker at once, each chunk carries one copy of the area data
+# {args} start_count: int, workers: int
+# {returns} int
+def start_chunksize(start_count, workers):
+    return max(1, ceil(start_count / (max(workers, 1) * CHUNKS_PER_WORKER)))
+
+
+# get routes from one start point to all cinemas for all start times
+# {args} data: dict of area data, start: (index, row of start points df)
+# {returns} dataframe
+def route_from_start(data, start):
+    cid, c = start
+    area_name = data['area_name']
+    times = data['times']
+    print(f'start: {cid}')
+    start_point = c['geometry']
+
+    # get DataFrame of closest stations to centre, columns: 'stop_name', ..., 'distance'
+    print(f'getting start stations...')
+    start_stations = get_stations(data['gtfs_df'], start_point, 10)
+    start_walks = get_walks_to_stations(start_point, start_stations, data['gtfs_df'], data['network'])
+
+    # calculate route for first start time and then add route for other start times
+    print(f'getting train routes for {area_name}...')
+    df = get_fastest_route(data['filtered_filename'], data['gtfs_df'], start_stations, start_point, data['end'],
+                           times[0], data['weekday'], data['date'], data['backend'], start_walks, data['network'])
+
+    for tid, t in enumerate(times):
+        if tid == 0:
+            continue
+        else:
+            new_df = get_fastest_route(data['filtered_filename'], data['gtfs_df'], start_stations, start_point,
+                                       data['end'], t, data['weekday'], data['date'], data['backend'],
+                                       start_walks, data['network'])
+            df = df.merge(new_df, how='left', on='cinema_name')
+
+    df['car_duration'] = data['car_durations'][cid]
+    df['foot_duration'] = data['foot_durations'][cid]
+    df['example_for'] = area_name
+    df['start_location'] = start_point
+    df['start_location'] = GeoSeries(df['start_location'])
+    df['distance_start_centroid'] = data['centroid_distances'][cid]
+    df['distance_start_cinema'] = df['cinema_name'].map(data['cinema_distances'].loc[cid])
+    write_used_times()
+    print_cache_stats()
+
+    return df
 
 
 # get routes for all start points in one area for given start times
 # {args} area_name: str, filtered_filename: str, cinemas: df, times: [int], centres: df, start_count: int,
-# weekday: str, date: str
+# weekday: str, date: str, backend: str, workers: int, network: str ('ors' or 'osm', see get_ors_duration),
+# pool: ProcessPoolExecutor from routing_pool or None
 # {returns} dataframe
-def route_in_area(area_name, filtered_filename, cinemas, times, start_points, start_count, weekday='Sat', date='20240309'):
+def route_in_area(area_name, filtered_filename, cinemas, times, start_points, start_count, weekday='Sat', date='20240309',
+                  backend='gtfsrouter', workers=1, network='ors', pool=None):
     # get centroid of area as proxy to calculate distance of start points to centre
     centroid = centroid_from_name(area_name)
-    gtfs_df = zip_to_df(path.join('gtfs_files', f'{filtered_filename}.zip'))
+    gtfs_df = zip_to_df(path.join('gtfs_files', f'{filtered_filename}.zip'), ['stops'])
 
     # get list of DataFrames of closest stations (one per POI)
     print(f'getting end stations...')
     end = get_all_stations(gtfs_df, cinemas, 10)
-
-    def get_df(cid, c):
-        print(f'start: {cid}')
-        start_point = c['geometry']
-        start_name = c['name']
-
-        # get DataFrame of closest stations to centre, columns: 'stop_name', ..., 'distance'
-        print(f'getting start stations...')
-        start = get_stations(gtfs_df, start_point, 10)
-
-        # calculate route for first start time and then add route for other start times
-        print(f'getting train routes for {area_name}...')
-        df = get_fastest_route(filtered_filename, gtfs_df, start, start_point, start_name, end, times[0], weekday, date)
-
-        for tid, t in enumerate(times):
-            if tid == 0:
-                continue
-            else:
-                new_df = get_fastest_route(filtered_filename, gtfs_df, start, start_point, start_name, end, t, weekday, date)
-                df = df.merge(new_df, how='left', on='cinema_name')
-
-        print(f'getting car durations for {area_name}...')
-        df['car_duration'] = get_all_ors_durations(start_point, cinemas, 'driving-car')
-        df['foot_duration'] = get_all_ors_durations(start_point, cinemas, 'foot-walking')
-        df['example_for'] = area_name
-        df['start_location'] = start_point
-        df['start_location'] = GeoSeries(df['start_location'])
-        df['distance_start_centroid'] = calc_distance(start_point, centroid, True)
-        cartesian_dist = calc_distance(start_point, cinemas)
-        df['distance_start_cinema'] = df.apply(lambda row: cartesian_dist[1][cartesian_dist[0].index(row['cinema_name'])], axis=1)
-
-        return df
-
-    dfs = [get_df(cid, c) for cid, c in start_points.iterrows()]
+    end['walks_from'] = [get_walks_from_stations(stations, location, gtfs_df, network)
+                         for stations, location in zip(end['stations'], end['cinema_location'])]
+
+    # car and foot durations from all start points to all cinemas in as few ors matrix requests as possible
+    print(f'getting car durations for {area_name}...')
+    car_durations = get_all_ors_durations_many(start_points['geometry'], cinemas, 'driving-car', network)
+    foot_durations = get_all_ors_durations_many(start_points['geometry'], cinemas, 'foot-walking', network)
+
+    # straight line distances of all start points to the centroid and to each cinema (by name, first cinema of a name)
+    centroid_distances = calc_distance_matrix(start_points['geometry'], [centroid])[:, 0]
+    cinema_distances = DataFrame(calc_distance_matrix(start_points['geometry'], cinemas['geometry']),
+                                 index=start_points.index, columns=cinemas['name'])
+    cinema_distances = cinema_distances.loc[:, ~cinema_distances.columns.duplicated()]
+
+    data = {'area_name': area_name, 'filtered_filename': filtered_filename, 'gtfs_df': gtfs_df, 'cinemas': cinemas,
+            'end': end, 'centroid': centroid, 'times': times, 'weekday': weekday, 'date': date, 'backend': backend,
+            'car_durations': dict(zip(start_points.index, car_durations)),
+            'foot_durations': dict(zip(start_points.index, foot_durations)), 'network': network,
+            'centroid_distances': dict(zip(start_points.index, centroid_distances)),
+            'cinema_distances': cinema_distances}
+    starts = list(start_points.iterrows())
+
+    # the start points are sent to the workers in chunks, data is pickled once per chunk instead of once per start
+    chunksize = start_chunksize(len(starts), workers)
+    if pool is None and workers > 1:
+        with routing_pool(workers) as area_pool:
+            dfs = list(area_pool.map(route_from_start, repeat(data), starts, chunksize=chunksize))
+    elif pool is not None:
+        # map returns the results in the order of the start points
+        dfs = list(pool.map(route_from_start, repeat(data), starts, chunksize=chunksize))
+    else:
+        dfs = [route_from_start(data, start) for start in starts]
 
     if isinstance(start_count, int) and start_count == 1:
         print('done!')
@@ -65,11 +133,12 @@ def route_in_area(area_name, filtered_filename, cinemas, times, start_points, st
 
 
 # check all necessary data is available for routing, get routes, format and save resulting dataframe
-# {args} area_name: string, full_gtfs: string, times: [int], start_count: int, weekday: str, date: str, batch: int/str
+# {args} area_name: string, full_gtfs: string, times: [int], start_count: int, weekday: str, date: str, batch: int/str,
+# backend: str, workers: int, network: str, pool: ProcessPoolExecutor or None
 # {returns} saves dfs to csv and gpkg
-def get_routes(area_name, full_gtfs, times, start_count, weekday, batch, date='20240309'):
-    areas = germany_admin('GEM')
-    in_area = areas[areas['GEN'] == area_name]
+def get_routes(area_name, full_gtfs, times, start_count, weekday, batch, date='20240309', backend='gtfsrouter',
+               workers=1, network='ors', pool=None):
+    in_area = admin_area(area_name)
 
     # check if gtfs subset for area exists
     if in_area['GEN'].values[0] not in EXTRACTED_NAME and in_area['GEN'].values[0] not in EXTRACTED_CHANGED:
@@ -98,9 +167,14 @@ def get_routes(area_name, full_gtfs, times, start_count, weekday, batch, date='2
         centres = start_count
         start_count = 4
         print('routing bbox corners')
+    elif batch == 'all':
+        centres = start_count
+        start_count = len(centres)
+        print(f'routing all {start_count} start points')
 
     # get routing results
-    routes = route_in_area(in_area['GEN'].values[0], gtfs_filename, cinemas, times, centres, start_count, weekday, date)
+    routes = route_in_area(in_area['GEN'].values[0], gtfs_filename, cinemas, times, centres, start_count, weekday, date,
+                           backend, workers, network, pool)
 
     # convert timedelta objects in dataframe to seconds
     for column in [col for col in routes.columns if 'duration' in col or 'walk' in col]:
@@ -0,0 +1,389 @@
+from bisect import bisect_left
+from numpy import array, argsort, concatenate, int64, nonzero, searchsorted, zeros, cumsum, bincount, where
+from pandas import DataFrame
+
+from scripts.utils import zip_to_df, gtfs_time_to_seconds
+from scripts.routing.transfers import cached_transfer_table
+
+# gtfsrouter weekday abbreviations and the corresponding columns of calendar.txt
+WEEKDAYS = {'Mon': 'monday', 'Tue': 'tuesday', 'Wed': 'wednesday', 'Thu': 'thursday', 'Fri': 'friday',
+            'Sat': 'saturday', 'Sun': 'sunday'}
+# value used for stops that cannot be reached
+UNREACHED = 2 ** 31 - 1
+# arrival profiles computed in this process for the timetable read from one cache file, keyed by target station
+PROFILES = {'cache_file': None, 'profiles': {}}
+# largest number of arrival profiles kept, the least recently used profiles are dropped first
+MAX_PROFILES = 64
+
+
+# convert seconds since the start of the service day to gtfs time
+# {args} seconds: int
+# {returns} str
+def seconds_to_gtfs_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+# read gtfs zip archive and convert it into a timetable of connections sorted by departure time
+# {args} zip_file: str, weekday: str, d_limit: int, min_transfer_time: int
+# {returns} dict of arrays
+def csa_timetable(zip_file, weekday, d_limit=200, min_transfer_time=300):
+    gtfs_df = zip_to_df(zip_file, ['stops', 'calendar', 'trips', 'routes', 'stop_times'])
+    stops = gtfs_df['stops'].reset_index(drop=True)
+    calendar = gtfs_df['calendar']
+
+    # only keep trips with services running on the given weekday
+    services = calendar[calendar[WEEKDAYS[weekday]] == 1]['service_id']
+    trips = gtfs_df['trips'][gtfs_df['trips']['service_id'].isin(services)].reset_index(drop=True)
+    trips = trips.merge(gtfs_df['routes'][['route_id', 'route_short_name']], how='left', on='route_id')
+
+    stop_times = gtfs_df['stop_times']
+    stop_times = stop_times[stop_times['trip_id'].isin(trips['trip_id'])]
+
+    # map gtfs ids to array positions
+    stop_index = DataFrame({'stop_id': stops['stop_id'], 'stop': range(len(stops))})
+    trip_index = DataFrame({'trip_id': trips['trip_id'], 'trip': range(len(trips))})
+    stop_times = stop_times.merge(stop_index, on='stop_id').merge(trip_index, on='trip_id')
+    stop_times = stop_times.sort_values(['trip', 'stop_sequence'])
+
+    arrival = gtfs_time_to_seconds(stop_times['arrival_time']).astype(int64)
+    departure = gtfs_time_to_seconds(stop_times['departure_time']).astype(int64)
+    # a stop with one missing time is left when it is reached, stops without times are passed without stopping
+    arrival = where(arrival < 0, departure, arrival)
+    departure = where(departure < 0, arrival, departure)
+    timed = nonzero(departure >= 0)[0]
+    trip = stop_times['trip'].to_numpy()[timed]
+    stop = stop_times['stop'].to_numpy()[timed]
+    arrival = arrival[timed]
+    departure = departure[timed]
+
+    # every pair of consecutive stops of a trip is one connection
+    same_trip = trip[:-1] == trip[1:]
+    order = argsort(departure[:-1][same_trip], kind='stable')
+
+    # footpaths between close stops in compressed sparse row format
+    fp_from, fp_to, fp_dur = cached_transfer_table(zip_file, stops, d_limit, min_transfer_time)
+    fp_order = argsort(fp_from, kind='stable')
+    fp_start = concatenate([zeros(1, int64), cumsum(bincount(fp_from, minlength=len(stops)))])
+
+    return {
+        'stop_id': stops['stop_id'].to_numpy(),
+        'stop_name': stops['stop_name'].to_numpy(),
+        'stop_lon': stops['stop_lon'].to_numpy(),
+        'stop_lat': stops['stop_lat'].to_numpy(),
+        'trip_id': trips['trip_id'].to_numpy(),
+        'route_name': trips['route_short_name'].astype(str).to_numpy(),
+        'dep_stop': stop[:-1][same_trip][order],
+        'arr_stop': stop[1:][same_trip][order],
+        'dep_time': departure[:-1][same_trip][order],
+        'arr_time': arrival[1:][same_trip][order],
+        'trip': trip[:-1][same_trip][order],
+        'fp_start': fp_start,
+        'fp_to': fp_to[fp_order],
+        'fp_dur': fp_dur[fp_order]
+    }
+
+
+# scan all connections departing after start_time once (connection scan algorithm)
+# targets are groups of stop indices (all stops of one station), the scan ends once every group has been reached
+# {args} timetable: dict, sources: array of stop indices, start_time: int, targets: [array of stop indices]
+# {returns} dict of arrays
+def csa_scan(timetable, sources, start_time, targets=None):
+    stop_count = len(timetable['stop_id'])
+    arrival = [UNREACHED] * stop_count
+    in_conn = [-1] * stop_count
+    foot_from = [-1] * stop_count
+    board = [-1] * len(timetable['trip_id'])
+
+    fp_start = timetable['fp_start'].tolist()
+    fp_to = timetable['fp_to'].tolist()
+    fp_dur = timetable['fp_dur'].tolist()
+
+    # walk from the sources to all stops within transfer distance
+    for s in sources:
+        arrival[s] = start_time
+    for s in sources:
+        for f in range(fp_start[s], fp_start[s + 1]):
+            if start_time + fp_dur[f] < arrival[fp_to[f]]:
+                arrival[fp_to[f]] = start_time + fp_dur[f]
+                foot_from[fp_to[f]] = s
+
+    is_target = [False] * stop_count
+    if targets is not None:
+        for group in targets:
+            for s in group:
+                is_target[s] = True
+
+    # latest of the earliest arrivals at the target stations
+    def target_bound():
+        return max(min(arrival[s] for s in group) for group in targets) if targets else UNREACHED
+    bound = target_bound()
+
+    first = int(searchsorted(timetable['dep_time'], start_time))
+    dep_stop = timetable['dep_stop'][first:].tolist()
+    arr_stop = timetable['arr_stop'][first:].tolist()
+    dep_time = timetable['dep_time'][first:].tolist()
+    arr_time = timetable['arr_time'][first:].tolist()
+    trip = timetable['trip'][first:].tolist()
+
+    for i in range(len(dep_time)):
+        # no connection departing after the best arrival at every target can improve them
+        if dep_time[i] >= bound:
+            break
+        t = trip[i]
+        if board[t] < 0:
+            if arrival[dep_stop[i]] > dep_time[i]:
+                continue
+            board[t] = first + i
+
+        s = arr_stop[i]
+        a = arr_time[i]
+        if a < arrival[s]:
+            arrival[s] = a
+            in_conn[s] = first + i
+            foot_from[s] = -1
+            for f in range(fp_start[s], fp_start[s + 1]):
+                if a + fp_dur[f] < arrival[fp_to[f]]:
+                    arrival[fp_to[f]] = a + fp_dur[f]
+                    in_conn[fp_to[f]] = -1
+                    foot_from[fp_to[f]] = s
+                    if is_target[fp_to[f]]:
+                        bound = target_bound()
+            if is_target[s]:
+                bound = target_bound()
+
+    return {'arrival': array(arrival, int64), 'in_conn': in_conn, 'foot_from': foot_from, 'board': board}
+
+
+# reconstruct the journey to one stop from the result of a connection scan
+# {args} timetable: dict, scan: dict, target: int
+# {returns} dataframe (same columns as gtfsrouter's gtfs_route) or None
+def csa_journey(timetable, scan, target):
+    if scan['arrival'][target] == UNREACHED:
+        return None
+
+    legs = []
+    s = target
+    # every step goes back to an earlier arrival, the guard only protects against zero duration loops
+    for _ in range(len(timetable['stop_id'])):
+        c = scan['in_conn'][s]
+        if c >= 0:
+            b = scan['board'][timetable['trip'][c]]
+            legs.append(nonzero(timetable['trip'][b:c + 1] == timetable['trip'][c])[0] + b)
+            s = timetable['dep_stop'][b]
+        elif scan['foot_from'][s] >= 0:
+            s = scan['foot_from'][s]
+        else:
+            break
+
+    return journey_to_df(timetable, legs[::-1])
+
+
+# convert the legs of a journey into a route dataframe
+# {args} timetable: dict, legs: [array of connection indices]
+# {returns} dataframe (same columns as gtfsrouter's gtfs_route) or None
+def journey_to_df(timetable, legs):
+    if not legs:
+        return None
+
+    trips = concatenate([timetable['trip'][conns[:1]].repeat(len(conns) + 1) for conns in legs])
+    stops = concatenate([concatenate([timetable['dep_stop'][conns[:1]], timetable['arr_stop'][conns]])
+                         for conns in legs])
+    arrivals = concatenate([concatenate([timetable['dep_time'][conns[:1]], timetable['arr_time'][conns]])
+                            for conns in legs])
+    departures = concatenate([concatenate([timetable['dep_time'][conns], timetable['arr_time'][conns[-1:]]])
+                              for conns in legs])
+
+    return DataFrame({'route_name': timetable['route_name'][trips], 'trip_name': timetable['trip_id'][trips],
+                      'stop_id': timetable['stop_id'][stops], 'stop_name': timetable['stop_name'][stops],
+                      'arrival_time': [seconds_to_gtfs_time(int(arr)) for arr in arrivals],
+                      'departure_time': [seconds_to_gtfs_time(int(dep)) for dep in departures]})
+
+
+# get indices of all stops with the given name
+# {args} timetable: dict, stop_name: str
+# {returns} array of int
+def stops_by_name(timetable, stop_name):
+    return nonzero(timetable['stop_name'] == stop_name)[0]
+
+
+# get fastest route between two stations departing after start_time, replaces gtfsrouter's gtfs_route
+# {args} timetable: dict, start: str, end: str, start_time: int
+# {returns} dataframe or None
+def csa_route(timetable, start, end, start_time):
+    sources = stops_by_name(timetable, start)
+    targets = stops_by_name(timetable, end)
+    if len(sources) == 0 or len(targets) == 0:
+        return None
+
+    scan = csa_scan(timetable, sources, start_time, [targets])
+    target = targets[scan['arrival'][targets].argmin()]
+
+    return csa_journey(timetable, scan, target)
+
+
+# get fastest routes from one station to several stations with a single scan
+# {args} timetable: dict, start: str, ends: [str], start_time: int
+# {returns} list of dataframes or None, in the order of ends
+def csa_route_many(timetable, start, ends, start_time):
+    sources = stops_by_name(timetable, start)
+    targets = [stops_by_name(timetable, end) for end in ends]
+    reachable = [group for group in targets if len(group) != 0]
+    if len(sources) == 0 or len(reachable) == 0:
+        return [None for _ in ends]
+
+    scan = csa_scan(timetable, sources, start_time, reachable)
+
+    def journey(group):
+        if len(group) == 0:
+            return None
+        return csa_journey(timetable, scan, group[scan['arrival'][group].argmin()])
+
+    return [journey(group) for group in targets]
+
+
+# insert a departure into the pareto profile of a stop, unless a later departure arrives at least as early
+# {args} profile: dict, stop: int, departure: int, arrival: int, enter: int, exit_conn: int
+# {returns} None, changes profile
+def add_to_profile(profile, stop, departure, arrival, enter, exit_conn):
+    deps = profile['deps'][stop]
+    arrs = profile['arrs'][stop]
+
+    pos = bisect_left(deps, departure)
+    if pos < len(deps) and arrs[pos] <= arrival:
+        return
+    # remove entries departing earlier (or at the same time) that do not arrive earlier
+    end = pos + 1 if pos < len(deps) and deps[pos] == departure else pos
+    start = end
+    while start > 0 and arrs[start - 1] >= arrival:
+        start -= 1
+
+    deps[start:end] = [departure]
+    arrs[start:end] = [arrival]
+    profile['enter'][stop][start:end] = [enter]
+    profile['exit'][stop][start:end] = [exit_conn]
+
+
+# scan all connections departing after earliest_departure backwards once and get the arrival profile of every
+# stop at the target station, i.e. the earliest arrival for every possible departure time (profile connection scan)
+# {args} timetable: dict, targets: array of stop indices, earliest_departure: int
+# {returns} dict
+def csa_profile(timetable, targets, earliest_departure):
+    stop_count = len(timetable['stop_id'])
+    fp_start = timetable['fp_start'].tolist()
+    fp_to = timetable['fp_to'].tolist()
+    fp_dur = timetable['fp_dur'].tolist()
+
+    # walking time from every stop to the target station, transfers are symmetric
+    walk = [UNREACHED] * stop_count
+    for s in targets:
+        walk[s] = 0
+    for s in targets:
+        for f in range(fp_start[s], fp_start[s + 1]):
+            walk[fp_to[f]] = min(walk[fp_to[f]], fp_dur[f])
+
+    profile = {'earliest': earliest_departure, 'walk': walk,
+               'deps': [[] for _ in range(stop_count)], 'arrs': [[] for _ in range(stop_count)],
+               'enter': [[] for _ in range(stop_count)], 'exit': [[] for _ in range(stop_count)]}
+    deps = profile['deps']
+    arrs = profile['arrs']
+
+    # earliest target arrival when staying on a trip and the connection to leave it at
+    trip_arrival = [UNREACHED] * len(timetable['trip_id'])
+    trip_exit = [-1] * len(timetable['trip_id'])
+
+    first = int(searchsorted(timetable['dep_time'], earliest_departure))
+    dep_stop = timetable['dep_stop'][first:].tolist()
+    arr_stop = timetable['arr_stop'][first:].tolist()
+    dep_time = timetable['dep_time'][first:].tolist()
+    arr_time = timetable['arr_time'][first:].tolist()
+    trip = timetable['trip'][first:].tolist()
+
+    for i in range(len(dep_time) - 1, -1, -1):
+        s = arr_stop[i]
+        t = trip[i]
+        exit_conn = first + i
+
+        # leave the trip here and walk to the target, or leave it here and transfer
+        best = arr_time[i] + walk[s] if walk[s] != UNREACHED else UNREACHED
+        pos = bisect_left(deps[s], arr_time[i])
+        if pos < len(deps[s]) and arrs[s][pos] < best:
+            best = arrs[s][pos]
+        # or stay on the trip, which is preferred if it arrives at the same time
+        if trip_arrival[t] != UNREACHED and trip_arrival[t] <= best:
+            best = trip_arrival[t]
+            exit_conn = trip_exit[t]
+        elif best != UNREACHED:
+            trip_arrival[t] = best
+            trip_exit[t] = exit_conn
+        else:
+            continue
+
+        # board here, or walk here from a close stop and board
+        u = dep_stop[i]
+        add_to_profile(profile, u, dep_time[i], best, first + i, exit_conn)
+        for f in range(fp_start[u], fp_start[u + 1]):
+            add_to_profile(profile, fp_to[f], dep_time[i] - fp_dur[f], best, first + i, exit_conn)
+
+    return profile
+
+
+# reconstruct the journey from a station departing at the given time from an arrival profile
+# {args} timetable: dict, profile: dict, sources: array of stop indices, departure: int
+# {returns} dataframe (same columns as gtfsrouter's gtfs_route) or None
+def csa_profile_journey(timetable, profile, sources, departure):
+    # first profile entry departing after the departure time, at the source stop arriving earliest
+    options = [(profile['arrs'][s][bisect_left(profile['deps'][s], departure)], s) for s in sources
+               if bisect_left(profile['deps'][s], departure) < len(profile['deps'][s])]
+    # like csa_journey, there is no route if the target is reached as early by walking from the start
+    walks = [departure + profile['walk'][s] for s in sources if profile['walk'][s] != UNREACHED]
+    if not options or (walks and min(walks) <= min(options)[0]):
+        return None
+    stop = min(options)[1]
+    pos = bisect_left(profile['deps'][stop], departure)
+
+    legs = []
+    # the guard only protects against zero duration loops
+    for _ in range(len(timetable['stop_id'])):
+        c = profile['enter'][stop][pos]
+        e = profile['exit'][stop][pos]
+        legs.append(nonzero(timetable['trip'][c:e + 1] == timetable['trip'][c])[0] + c)
+
+        # walk to the target after leaving the trip, unless transferring arrives earlier
+        stop = int(timetable['arr_stop'][e])
+        arrival = int(timetable['arr_time'][e])
+        walk = profile['walk'][stop]
+        pos = bisect_left(profile['deps'][stop], arrival)
+        if pos >= len(profile['deps'][stop]) or (walk != UNREACHED and arrival + walk <= profile['arrs'][stop][pos]):
+            break
+
+    return journey_to_df(timetable, legs)
+
+
+# get fastest routes from one station to several stations from arrival profiles of the stations, the profiles are
+# computed once per station and reused for all later start stations and departure times
+# profiles are kept for the timetable of one cache file (see gtfs_routing.format_gtfs), the profiles of the previous
+# timetable are dropped when another one is routed, timetables without cache file get new profiles on every call
+# at most MAX_PROFILES profiles are kept, memory grows with the stops of the feed times the kept target stations
+# {args} timetable: dict, start: str, ends: [str], start_time: int
+# {returns} list of dataframes or None, in the order of ends
+def csa_profile_routes(timetable, start, ends, start_time):
+    sources = stops_by_name(timetable, start)
+    cache_file = timetable.get('cache_file')
+    if cache_file is None or PROFILES['cache_file'] != cache_file:
+        PROFILES['cache_file'] = cache_file
+        PROFILES['profiles'] = {}
+    profiles = PROFILES['profiles'] if cache_file is not None else {}
+
+    def route(end):
+        # like csa_route_many and gtfsrouter, there is no route from a station to itself
+        if end == start:
+            return None
+        if end not in profiles or profiles[end]['earliest'] > start_time:
+            profiles[end] = csa_profile(timetable, stops_by_name(timetable, end), start_time)
+        profile = profiles.pop(end)
+        profiles[end] = profile
+        while len(profiles) > MAX_PROFILES:
+            del profiles[next(iter(profiles))]
+        return csa_profile_journey(timetable, profile, sources, start_time)
+
+    return [route(end) for end in ends]
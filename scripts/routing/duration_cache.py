@@ -0,0 +1,126 @@
+from os import path, makedirs
+from sqlite3 import connect
+from time import time
+from pandas import Timedelta
+
+from scripts.constants import RESULTS_PATH
+
+# decimal places coordinates are rounded to before they are used as key, 5 places are about one metre
+COORD_PRECISION = 5
+# largest number of durations kept in the cache, the least recently used ones are deleted beyond that
+MAX_CACHED_DURATIONS = 2000000
+# number of durations inserted by a process between two checks of the cache size
+EVICT_EVERY = 50000
+# number of cache hits collected before their last use time is written to the cache
+USED_BATCH = 10000
+KEY_COLUMNS = 'profile, start_lon, start_lat, end_lon, end_lat'
+# open cache connection of this process, hits/misses of its lookups, durations inserted since the last size check
+# and keys of hits whose last use time is not written yet
+DURATION_CACHE = {'store': None, 'hits': 0, 'misses': 0, 'inserted': 0, 'used': set()}
+
+
+# open (and create) the sqlite cache of ors durations, shared by all areas and processes
+# {args} -
+# {returns} sqlite connection
+def open_duration_cache():
+    if DURATION_CACHE['store'] is None:
+        makedirs(RESULTS_PATH, exist_ok=True)
+        # long timeout and write-ahead log, so several processes can use the same cache
+        store = connect(path.join(RESULTS_PATH, 'ors_durations.sqlite'), timeout=60)
+        store.execute('PRAGMA journal_mode=WAL')
+        store.execute('CREATE TABLE IF NOT EXISTS durations (profile TEXT, start_lon REAL, start_lat REAL, '
+                      'end_lon REAL, end_lat REAL, duration REAL, used REAL, '
+                      'PRIMARY KEY (profile, start_lon, start_lat, end_lon, end_lat))')
+        store.execute('CREATE INDEX IF NOT EXISTS durations_used ON durations (used)')
+        # keys of one lookup, the temporary table only exists for this connection
+        store.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (profile TEXT, start_lon REAL, start_lat REAL, '
+                      'end_lon REAL, end_lat REAL)')
+        store.commit()
+        DURATION_CACHE['store'] = store
+
+    return DURATION_CACHE['store']
+
+
+# get cache key of a trip, coordinates are rounded so the same stop or point always gives the same key
+# {args} start: (lon, lat), end: (lon, lat), profile: str, precision: int
+# {returns} tuple
+def duration_key(start, end, profile, precision=COORD_PRECISION):
+    return (profile, round(float(start[0]), precision), round(float(start[1]), precision),
+            round(float(end[0]), precision), round(float(end[1]), precision))
+
+
+# look up cached durations of trips with one query, trips ors could not route are cached as None
+# the last use times of the hits are written in batches of USED_BATCH
+# {args} keys: list of tuples from duration_key
+# {returns} dict of key: Timedelta or None, only containing the keys found in the cache
+def get_cached_durations(keys):
+    store = open_duration_cache()
+    found = {}
+    if keys:
+        with store:
+            store.execute('DELETE FROM lookup')
+            store.executemany('INSERT INTO lookup VALUES (?, ?, ?, ?, ?)', list(dict.fromkeys(keys)))
+            rows = store.execute(f'SELECT {KEY_COLUMNS}, duration FROM lookup JOIN durations USING ({KEY_COLUMNS})')
+            for *key, duration in rows:
+                found[tuple(key)] = Timedelta(duration, 's') if duration is not None else None
+
+    DURATION_CACHE['used'].update(found)
+    if len(DURATION_CACHE['used']) >= USED_BATCH:
+        write_used_times()
+    DURATION_CACHE['hits'] += len(found)
+    DURATION_CACHE['misses'] += len(keys) - len(found)
+
+    return found
+
+
+# write the last use time of the collected cache hits
+# {args} -
+# {returns} None, writes to cache
+def write_used_times():
+    if not DURATION_CACHE['used']:
+        return
+
+    store = open_duration_cache()
+    now = time()
+    with store:
+        store.executemany(f'UPDATE durations SET used = ? WHERE ({KEY_COLUMNS}) = (?, ?, ?, ?, ?)',
+                          [(now, *key) for key in DURATION_CACHE['used']])
+    DURATION_CACHE['used'] = set()
+
+
+# save durations of trips, every EVICT_EVERY inserted durations the least recently used ones are deleted if the
+# cache has grown too large
+# {args} durations: dict of key: Timedelta or None, max_size: int
+# {returns} None, writes to cache
+def cache_durations(durations, max_size=MAX_CACHED_DURATIONS):
+    if not durations:
+        return
+
+    store = open_duration_cache()
+    now = time()
+    with store:
+        store.executemany('INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          [(*key, dur.total_seconds() if dur is not None else None, now)
+                           for key, dur in durations.items()])
+    DURATION_CACHE['inserted'] += len(durations)
+    if DURATION_CACHE['inserted'] < EVICT_EVERY:
+        return
+
+    # durations used since the last write must not be deleted as least recently used
+    write_used_times()
+    DURATION_CACHE['inserted'] = 0
+    with store:
+        size = store.execute('SELECT COUNT(*) FROM durations').fetchone()[0]
+        if size > max_size:
+            store.execute('DELETE FROM durations WHERE rowid IN '
+                          '(SELECT rowid FROM durations ORDER BY used LIMIT ?)', (size - max_size,))
+
+
+# print hits and misses of the duration cache in this process
+# {args} -
+# {returns} None, prints
+def print_cache_stats():
+    lookups = DURATION_CACHE['hits'] + DURATION_CACHE['misses']
+    if lookups:
+        print(f'ors duration cache: {DURATION_CACHE["hits"]} hits, {DURATION_CACHE["misses"]} misses '
+              f'({DURATION_CACHE["hits"] / lookups:.0%} hit rate)')
@@ -1,52 +1,83 @@
-from os import path
-from numpy import load, save
-from numpy import append as np_append
-from rpy2 import robjects as ro
-from rpy2.robjects import pandas2ri
+from os import path, makedirs, replace, getpid
+from numpy import where
 from pandas import DataFrame, Timedelta, read_csv, isnull
 
-from scripts.utils import gtfs_time_to_pandas_datetime
+from scripts.utils import gtfs_time_to_seconds, zip_to_df
 from scripts.constants import RESULTS_PATH
-from scripts.routing.ors_routing import get_walk_to_station
-
-# R functions
-r_library = ro.r['library']
-r_parse = ro.r['parse']
-r_eval = ro.r['eval']
-r_datetime = ro.r['as.POSIXct']
-r_difftime = ro.r['difftime']
-
-# get R libraries
-r_library('gtfsrouter')
-
-# gtfsrouter functions
-r_extract_gtfs = ro.r['extract_gtfs']
-r_gtfs_transfer_table = ro.r['gtfs_transfer_table']
-r_gtfs_timetable = ro.r['gtfs_timetable']
-r_gtfs_route = ro.r['gtfs_route']
+from scripts.routing.ors_routing import get_walk_to_station, get_walks_to_stations, get_walks_from_stations
+from scripts.routing.csa_routing import csa_timetable, csa_route_many, csa_profile_routes
+from scripts.routing.timetable_cache import timetable_cache_path, save_timetable, load_timetable
+from scripts.routing.transfers import transfers_to_df
+from scripts.routing.route_bounds import network_max_speed, duration_lower_bounds
+from scripts.routing.route_memo import in_memo, add_to_memo
+from scripts.routing.route_store import (open_route_store, start_key, save_route, save_walk, get_stored_route,
+                                         get_stored_walk, get_stored_legs)
+
+# R functions of rpy2 and gtfsrouter, loaded by r_functions when the gtfsrouter backend is used first
+R = {}
+# timetable prepared last in this process, keyed by its cache file, a process routes one feed after the other
+TIMETABLES = {}
+# fastest speed between two stops in each feed in m/s, keyed by feed name
+MAX_SPEEDS = {}
+# number of start stops routed and skipped by the lower bound in this process
+PRUNING_STATS = {'routed': 0, 'skipped': 0}
+# backend and weekday of the routes earlier runs saved as one csv file per route, they are only reused for these
+LEGACY_ROUTES = ('gtfsrouter', 'Sat')
+
+
+# load rpy2 and the R library gtfsrouter, the python backends run without R
+# {args} -
+# {returns} dict of R functions
+def r_functions():
+    if not R:
+        from rpy2 import robjects as ro
+        from rpy2.robjects import pandas2ri
+
+        ro.r['library']('gtfsrouter')
+        R.update({
+            'ro': ro,
+            'pandas2ri': pandas2ri,
+            'parse': ro.r['parse'],
+            'eval': ro.r['eval'],
+            'save_rds': ro.r['saveRDS'],
+            'read_rds': ro.r['readRDS'],
+            # gtfsrouter functions
+            'extract_gtfs': ro.r['extract_gtfs'],
+            'gtfs_timetable': ro.r['gtfs_timetable'],
+            'gtfs_route': ro.r['gtfs_route'],
+            # replace the transfer table of a feed, extract_gtfs reads stop ids as character
+            'set_transfers': ro.r('function(gtfs, transfers) { gtfs$transfers <- '
+                                  'data.table::as.data.table(transfers); gtfs }')
+        })
+
+    return R
 
 
 # get duration of fastest route, return list of datetime durations
+# durations are integer differences of gtfs times in seconds, Timedelta objects are only created for the result
 # {args} routes: [df], date: str, only_fastest: boolean, only_one: boolean
 # {returns} dataframe or dict
 def get_route_duration(routes, date='20240106', only_fastest=True, only_one=False):
-    def calc_dur(route):
-        if isinstance(route, DataFrame):
-            start_t = gtfs_time_to_pandas_datetime(date, route['departure_time'].iloc[0])
-            end_t = gtfs_time_to_pandas_datetime(date, route['arrival_time'].iloc[len(route) - 1])
-            diff = end_t - start_t
-
-            return diff
-
     if only_one:
-        return calc_dur(routes)
-
-    # go over all routes and calculate duration
-    dur_opt = [calc_dur(route) for route in routes]
+        routes = [routes]
+
+    # parse first departure and last arrival of all routes in one pass, routes that are not dataframes get -1
+    is_route = [isinstance(route, DataFrame) for route in routes]
+    times = gtfs_time_to_seconds(
+        [route['departure_time'].iloc[0] if valid else None for route, valid in zip(routes, is_route)] +
+        [route['arrival_time'].iloc[len(route) - 1] if valid else None for route, valid in zip(routes, is_route)])
+    departures = times[:len(routes)]
+    arrivals = times[len(routes):]
+    has_duration = (departures >= 0) & (arrivals >= 0)
+    seconds = arrivals - departures
+
+    dur_opt = [Timedelta(int(sec), 's') if valid else None for sec, valid in zip(seconds, has_duration)]
+    if only_one:
+        return dur_opt[0]
     route_id = range(len(dur_opt))
 
     # return error if no duration could be calculated
-    if dur_opt == [] or all([not isinstance(route, Timedelta) for route in dur_opt]):
+    if not has_duration.any():
         raise Exception('duration can be calculated for no route')
     # return duration for all routes
     elif not only_fastest:
@@ -54,12 +85,10 @@ def get_route_duration(routes, date='20240106', only_fastest=True, only_one=Fals
         return df.sort_values('duration')
     # return duration and id of the fastest route in list
     else:
-        durations = list(filter(lambda item: isinstance(item, Timedelta), dur_opt))
-        min_route = min(durations)
-        min_route_id = route_id[dur_opt.index(min_route)]
-        fastest_out_of = len(durations)
+        min_route_id = int(where(has_duration, seconds, seconds.max() + 1).argmin())
+        fastest_out_of = int(has_duration.sum())
 
-        return {'duration': min_route, 'route_id': min_route_id, 'out_of': fastest_out_of}
+        return {'duration': dur_opt[min_route_id], 'route_id': min_route_id, 'out_of': fastest_out_of}
 
 
 # {args} duration: Timedelta, walk: [Timedelta]
@@ -71,21 +100,49 @@ def timedelta_addition(duration, walk):
         return duration + walk[0] + walk[1]
 
 
-# get GTFS files and format them
-# {args} filename: str, weekday: str
-# {returns} gtfs feed to be processed by R gtfsrouter
-def format_gtfs(filename, weekday):
+# get GTFS files and format them, prepared timetables are cached on disk next to the zip archive
+# {args} filename: str, weekday: str, backend: str ('gtfsrouter', 'csa' or 'csa_profile')
+# {returns} gtfs feed to be processed by R gtfsrouter or timetable dict for the python connection scan
+def format_gtfs(filename, weekday, backend='gtfsrouter'):
     zip_file = path.join('gtfs_files/', f'{filename}.zip')
-    gtfs = r_extract_gtfs(zip_file)
+    d_limit = 200
+    min_transfer_time = 300
+    if backend not in ['gtfsrouter', 'csa', 'csa_profile']:
+        raise ValueError(f'unknown routing backend {backend}')
+
+    # the cache file name contains the hash of the zip archive, so rewritten feeds are prepared again
+    cache_file = timetable_cache_path(zip_file, weekday, d_limit, min_transfer_time, backend)
+    if cache_file in TIMETABLES:
+        return TIMETABLES[cache_file]
+    # only the timetable of the current feed is kept alive
+    TIMETABLES.clear()
+
+    if backend in ['csa', 'csa_profile']:
+        if path.isfile(cache_file):
+            gtfs = load_timetable(cache_file)
+        else:
+            gtfs = csa_timetable(zip_file, weekday, d_limit, min_transfer_time)
+            save_timetable(gtfs, cache_file)
+        # arrival profiles of csa_profile_routes are kept per cache file, it changes with the content of the feed
+        gtfs['cache_file'] = cache_file
+    elif path.isfile(cache_file):
+        gtfs = r_functions()['read_rds'](cache_file)
+    else:
+        r = r_functions()
+        gtfs = r['extract_gtfs'](zip_file)
+
+        # create transfer table, it is built in python with a spatial index and shared with the python backends
+        transfers = transfers_to_df(zip_file, zip_to_df(zip_file, ['stops'])['stops'], d_limit, min_transfer_time)
+        gtfs = r['set_transfers'](gtfs, pandas_to_r_df(transfers))
+        # convert gtfs data in routable format
+        gtfs = r['gtfs_timetable'](gtfs, day=weekday)
 
-    # create transfer table
-    gtfs = r_gtfs_transfer_table(
-        gtfs,
-        d_limit=200,
-        min_transfer_time=300)
-    # convert gtfs data in routable format
-    gtfs = r_gtfs_timetable(gtfs, day=weekday)
+        makedirs(path.dirname(cache_file), exist_ok=True)
+        tmp_file = f'{cache_file}.{getpid()}.tmp'
+        r['save_rds'](gtfs, file=tmp_file)
+        replace(tmp_file, cache_file)
 
+    TIMETABLES[cache_file] = gtfs
     return gtfs
 
 
@@ -94,9 +151,10 @@ def format_gtfs(filename, weekday):
 # {returns} list of args to be processed by R gtfsrouter
 def format_args(start, end, time):
     args = ['start', 'end', 'time']
+    r = r_functions()
 
     def args_parse(string):
-        arg = r_eval(r_parse(text=string))
+        arg = r['eval'](r['parse'](text=string))
         return arg
 
     args[0] = args_parse(f'from="{start}"')
@@ -106,31 +164,52 @@ def format_args(start, end, time):
     return args
 
 
+# convert pandas DataFrames to R DataFrames
+# {args} dataframe: (pandas) dataframe
+# {returns} R dataframe
+def pandas_to_r_df(dataframe):
+    ro = r_functions()['ro']
+    with (ro.default_converter + r_functions()['pandas2ri'].converter).context():
+        return ro.conversion.get_conversion().py2rpy(dataframe)
+
+
 # convert R DataFrames to pandas DataFrames
 # {args} r_dataframe: R dataframe
 # {returns} (pandas) dataframe
 def r_to_pandas_df(r_dataframe):
-    with (ro.default_converter + pandas2ri.converter).context():
+    ro = r_functions()['ro']
+    with (ro.default_converter + r_functions()['pandas2ri'].converter).context():
         return ro.conversion.get_conversion().rpy2py(r_dataframe)
 
 
 # get train routes from one point to another, return list of pandas dataframes
-# {args} gtfs_data: str or gtfs feed, start_df: df of stations, end: [df of stations], time: int, weekday: str
+# {args} gtfs_data: str or gtfs feed, start_df: df of stations, end: [df of stations], time: int, weekday: str,
+# backend: str
 # {returns} list of df of routes
-def train_route(gtfs_data, start, end_df, time, weekday=None):
+def train_route(gtfs_data, start, end_df, time, weekday=None, backend='gtfsrouter'):
     if isinstance(gtfs_data, str):
         if weekday is None:
             raise Exception('Give weekday for gtfs formatting')
-        gtfs = format_gtfs(gtfs_data, weekday)
+        gtfs = format_gtfs(gtfs_data, weekday, backend)
     else:
         gtfs = gtfs_data
     stops = end_df['stop_name']  # stops: pandas series
 
+    # timetables of the python backend are dicts of arrays, one scan gives the routes to all stops
+    # profiles cover all departure times from the first requested one, so later times need no new scans
+    if isinstance(gtfs, dict) and backend == 'csa_profile':
+        return csa_profile_routes(gtfs, start, stops.tolist(), round(time * 3600))
+    elif isinstance(gtfs, dict):
+        return csa_route_many(gtfs, start, stops.tolist(), round(time * 3600))
+
     # calculate routes from each close station, if no route possible write None
+    r = r_functions()
+    ro = r['ro']
+
     def get_route(row):
         args = format_args(start, row, time)
         try:
-            route = r_gtfs_route(
+            route = r['gtfs_route'](
                 gtfs,
                 args[0],
                 args[1],
@@ -155,19 +234,36 @@ def get_change_count(route_df):
     return (route_df['route_name'] != route_df['route_name'].shift()).sum() - 1
 
 
+# key of a route in the route store and the memos, routes depend on the weekday and the backend they were routed with
+# {args} cinema_name: str, stop_name: str, time: int, weekday: str, backend: str
+# {returns} str
+def route_key(cinema_name, stop_name, time, weekday, backend):
+    return f'{cinema_name}_{stop_name}_{time}_{weekday}_{backend}'
+
+
 # get fastest route from one start point to one cinema
-# {args} gtfs_zip: str, gtfs_df: df, start: df, start_point: Point, start_name: str, poi_list: [df], time: int,
-# weekday: str, date: str
+# {args} gtfs_zip: str, gtfs_df: df, start: df, start_point: Point, poi_list: [df], time: int, weekday: str,
+# date: str, backend: str, start_walks: dict of walks from start point to start stations,
+# network: str ('ors' or 'osm', see get_ors_duration)
 # {returns} dataframe
-def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, start_name, poi_list, time, weekday, date):
+def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, poi_list, time, weekday, date, backend='gtfsrouter',
+                      start_walks=None, network='ors'):
     gtfs = None
     route_files_path = path.join(RESULTS_PATH, 'routes', gtfs_zip.rsplit('_')[0])
-    not_possible = load(path.join(RESULTS_PATH, 'routes_not_possible.npy'))
-    if path.isfile(path.join(RESULTS_PATH, 'routes_not_fast.npy')):
-        not_fastest = load(path.join(RESULTS_PATH, 'routes_not_fast.npy'))
-    else:
-        not_fastest = []
+    store = open_route_store(gtfs_zip.rsplit('_')[0])
     start_stops = start['stop_name']
+    # walks and routes not fast enough are saved per start point, start names are not unique
+    start_id = start_key(start_point)
+    if gtfs_zip not in MAX_SPEEDS:
+        MAX_SPEEDS[gtfs_zip] = network_max_speed(path.join('gtfs_files', f'{gtfs_zip}.zip'))
+    routed = 0
+    skipped = 0
+    # walks to the start stations and from the stations of each cinema, requested once and looked up for every route
+    if start_walks is None:
+        start_walks = get_walks_to_stations(start_point, start, gtfs_df, network)
+    if 'walks_from' not in poi_list:
+        poi_list['walks_from'] = [get_walks_from_stations(stations, location, gtfs_df, network)
+                                  for stations, location in zip(poi_list['stations'], poi_list['cinema_location'])]
 
     total_routes = []
     total_durations = []
@@ -179,6 +275,7 @@ def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, start_name, poi_lis
     for pid, poi in enumerate(poi_list['stations']):
         cinema_name = poi_list['cinema_name'][pid]
         cinema_location = poi_list['cinema_location'][pid]
+        cinema_walks = poi_list['walks_from'][pid]
         print(f'cinema: {cinema_name}')
 
         chosen_route = DataFrame()
@@ -186,44 +283,71 @@ def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, start_name, poi_lis
         fastest_dur = dur_default
         walk_to = None
         walk_from = None
+        transit_dur = None
+        changes = None
         start_stop = ''
         write_to_file = True
-        # loop over closest stations of poi, return only the fastest
-        for rid, row in enumerate(start_stops):
+        # loop over closest stations of poi by ascending lower bound of the total duration, return only the fastest
+        bounds = duration_lower_bounds(start, start_point, poi, cinema_location, MAX_SPEEDS[gtfs_zip])
+        order = bounds.argsort(kind='stable')
+        for rank, rid in enumerate(order):
+            row = start_stops.iloc[rid]
+            # no later stop can beat the fastest route once its lower bound does not
+            if isinstance(fastest_dur, Timedelta) and bounds[rid] >= fastest_dur.total_seconds():
+                skipped += len(order) - rank
+                print(f'skipped {len(order) - rank} stops by lower bound')
+                break
+
             invalid = '<>:"/\|?* '
             stop_name = ''.join(char for char in row if char not in invalid)
 
-            query_params = f'{cinema_name}_{start_name}_{stop_name}_{time}'
-            route_params = f'{cinema_name}_{stop_name}_{time}'
-            route_filename = path.join(route_files_path, f'{route_params}.csv')
+            route_params = route_key(cinema_name, stop_name, time, weekday, backend)
+            query_params = f'{route_params}_{start_id}'
+            route_filename = path.join(route_files_path, f'{cinema_name}_{stop_name}_{time}.csv')
+            # routes saved by earlier runs as one csv file per route are moved into the route store
+            if (backend, weekday) == LEGACY_ROUTES and get_stored_route(store, route_params) is None and \
+                    path.isfile(route_filename):
+                legacy_route = read_csv(route_filename)
+                walk = get_walk_to_station(legacy_route, start_point, cinema_location, gtfs_df, start_walks,
+                                           cinema_walks, network)
+                save_route(store, route_params, legacy_route, get_route_duration(legacy_route, only_one=True), walk[1],
+                           get_change_count(legacy_route))
+                save_walk(store, route_params, start_id, walk[0])
+
             # check if same start (row) has been calculated to cinema before and continue if it has
-            if path.isfile(route_filename):
-                chosen_route = read_csv(route_filename)
-                dur = get_route_duration(chosen_route, only_one=True)
-                walk = get_walk_to_station(chosen_route, start_point, cinema_location, gtfs_df)
-                fastest_dur = timedelta_addition(dur, walk)
-                walk_to = walk[0]
-                walk_from = walk[1]
+            stored = get_stored_route(store, route_params)
+            if stored is not None:
+                walk_to = get_stored_walk(store, route_params, start_id)
+                if walk_to is None:
+                    walk_to = get_walk_to_station(get_stored_legs(store, route_params), start_point, cinema_location,
+                                                  gtfs_df, start_walks, cinema_walks, network)[0]
+                    save_walk(store, route_params, start_id, walk_to)
+                walk_from = stored['walk_from']
+                transit_dur = stored['duration']
+                changes = stored['changes']
+                fastest_dur = timedelta_addition(transit_dur, [walk_to, walk_from])
                 start_stop = stop_name
                 write_to_file = False
-                print(f'read route from {row} from file')
+                print(f'read route from {row} from store')
                 continue
-            elif route_params in not_possible or query_params in not_fastest:
+            elif in_memo('routes_not_possible', route_params) or in_memo('routes_not_fast', query_params):
                 continue
             else:
                 if gtfs is None:
-                    gtfs = format_gtfs(gtfs_zip, weekday)
-                route_opt = train_route(gtfs, row, poi, time)
+                    gtfs = format_gtfs(gtfs_zip, weekday, backend)
+                route_opt = train_route(gtfs, row, poi, time, backend=backend)
+                routed += 1
 
                 # if all routes to this POI's stop failed go to next stop
                 if all([route is None for route in route_opt]):
                     print(f'no route possible from {row}')
-                    not_possible = np_append(not_possible, [route_params])
+                    add_to_memo('routes_not_possible', route_params)
                     continue
                 print(f'got routes from {row}')
 
                 dur_df = get_route_duration(route_opt, date, False)
-                dur_df['walk'] = [get_walk_to_station(route, start_point, cinema_location, gtfs_df) for route in route_opt]
+                dur_df['walk'] = [get_walk_to_station(route, start_point, cinema_location, gtfs_df, start_walks,
+                                                      cinema_walks, network) for route in route_opt]
                 dur_df['total_duration'] = dur_df.apply(
                     lambda dur_row: timedelta_addition(dur_row['duration'], dur_row['walk']), axis=1)
 
@@ -236,14 +360,18 @@ def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, start_name, poi_lis
                 min_total = min(total)
 
                 if fastest_dur > min_total:
-                    chosen_route = route_opt[dur_df[dur_df['total_duration'] == min_total]['route_id'].values[0]]
+                    fastest = dur_df[dur_df['total_duration'] == min_total]
+                    chosen_route = route_opt[fastest['route_id'].values[0]]
                     fastest_dur = min_total
-                    fastest_walk = dur_df[dur_df['total_duration'] == min_total]['walk'].values[0]
+                    fastest_walk = fastest['walk'].values[0]
                     walk_to = fastest_walk[0]
                     walk_from = fastest_walk[1]
+                    transit_dur = Timedelta(fastest['duration'].values[0])
+                    changes = get_change_count(chosen_route)
                     start_stop = stop_name
+                    write_to_file = True
                 else:
-                    not_fastest = np_append(not_fastest, [query_params])
+                    add_to_memo('routes_not_fast', query_params)
                     continue
 
         if fastest_dur == dur_default:
@@ -253,23 +381,25 @@ def get_fastest_route(gtfs_zip, gtfs_df, start, start_point, start_name, poi_lis
             walks_from.append(None)
             total_changes.append(None)
         else:
-            chosen_route_filename = f'{route_params}.csv'
-            total_routes.append(chosen_route_filename)
+            chosen_route_key = route_key(cinema_name, start_stop, time, weekday, backend)
+            total_routes.append(chosen_route_key)
             total_durations.append(fastest_dur)
             walks_to.append(walk_to)
             walks_from.append(walk_from)
-            total_changes.append(get_change_count(chosen_route))
+            total_changes.append(changes)
 
             if write_to_file:
-                chosen_route.to_csv(path.join(route_files_path, chosen_route_filename))
+                save_route(store, chosen_route_key, chosen_route, transit_dur, walk_from, changes)
+                save_walk(store, chosen_route_key, start_id, walk_to)
                 print('route written!')
 
         names.append(cinema_name)
 
-    if len(not_possible) != 0:
-        save(path.join(RESULTS_PATH, 'routes_not_possible'), not_possible, False)
-    if len(not_fastest) != 0:
-        save(path.join(RESULTS_PATH, 'routes_not_fast'), not_fastest, False)
+    store.close()
+    PRUNING_STATS['routed'] += routed
+    PRUNING_STATS['skipped'] += skipped
+    print(f'routed from {routed} start stops, skipped {skipped} by lower bound '
+          f'({PRUNING_STATS["skipped"]} of {PRUNING_STATS["routed"] + PRUNING_STATS["skipped"]} in this process)')
 
     return DataFrame(
         {'cinema_name': names, f'{time}_total_route': total_routes, f'{time}_total_duration': total_durations,
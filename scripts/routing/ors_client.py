@@ -0,0 +1,135 @@
+from time import sleep
+from random import random
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from openrouteservice import Client, exceptions
+from openrouteservice.directions import directions
+from openrouteservice.distance_matrix import distance_matrix
+
+ORS_URL = 'http://localhost:8082/ors'
+# largest number of requests sent to ors at the same time by a process, size of its thread pool and connection pool
+ORS_CONCURRENCY = 8
+# number of retries of a request that failed with a transient error, the wait doubles with every retry
+ORS_RETRIES = 4
+# seconds waited before the first retry
+ORS_BACKOFF = 0.5
+# ors error codes of requests without a route: route not found, point not found (no routable point near a location)
+UNROUTABLE_CODES = {2009, 2010}
+# ors client and request threads of this process, created on first use and kept for the lifetime of the process
+ORS = {'client': None, 'executor': None, 'lock': Lock()}
+
+
+# openrouteservice Client sending its requests with a given requests session instead of a session of its own
+class SessionClient(Client):
+    def __init__(self, session, **kwargs):
+        super().__init__(**kwargs)
+        self._session.close()
+        self._session = session
+
+
+# get a requests session keeping one connection to ors alive for each request thread
+# {args} size: int
+# {returns} requests Session
+def ors_session(size=ORS_CONCURRENCY):
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# get the ors client shared by all threads of this process, too many requests (429) are retried by with_retries
+# {args} -
+# {returns} SessionClient
+def ors_client():
+    with ORS['lock']:
+        if ORS['client'] is None:
+            ORS['client'] = SessionClient(ors_session(ORS_CONCURRENCY), base_url=ORS_URL,
+                                          retry_over_query_limit=False)
+
+    return ORS['client']
+
+
+# get the thread pool sending concurrent requests to ors, its threads reuse the connections of the shared session
+# {args} -
+# {returns} ThreadPoolExecutor
+def ors_executor():
+    with ORS['lock']:
+        if ORS['executor'] is None:
+            ORS['executor'] = ThreadPoolExecutor(ORS_CONCURRENCY, thread_name_prefix='ors')
+
+    return ORS['executor']
+
+
+# apply a request to all items on the ors threads, with at most concurrency requests sent at the same time
+# the items are submitted from the calling thread, so requests must not call ors_map themselves
+# {args} request: function(item), items: iterable, concurrency: int (at most ORS_CONCURRENCY)
+# {returns} list of results in the order of items
+def ors_map(request, items, concurrency=ORS_CONCURRENCY):
+    executor = ors_executor()
+    results = []
+    running = {}
+    for iid, item in enumerate(items):
+        results.append(None)
+        if len(running) >= max(1, concurrency):
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+        running[executor.submit(request, item)] = iid
+    for future, iid in running.items():
+        results[iid] = future.result()
+
+    return results
+
+
+# check if a failed request may succeed when it is sent again
+# ors answers server errors (5xx) and too many requests (429) with an ApiError like unroutable requests (4xx)
+# {args} err: Exception
+# {returns} boolean
+def is_transient(err):
+    if isinstance(err, exceptions.ApiError):
+        return err.status == 429 or err.status >= 500
+    return isinstance(err, (ConnectionError, exceptions.Timeout, exceptions.HTTPError))
+
+
+# check if ors answered that there is no route for a request, only then there is no duration to cache as None
+# {args} err: Exception
+# {returns} boolean
+def is_unroutable(err):
+    if not isinstance(err, exceptions.ApiError) or not 400 <= err.status < 500 or not isinstance(err.message, dict):
+        return False
+    error = err.message.get('error')
+    return isinstance(error, dict) and error.get('code') in UNROUTABLE_CODES
+
+
+# send a request to ors, retrying with exponential backoff if ors cannot be reached, times out or answers with a
+# server error or too many requests, ApiErrors of other 4xx responses (unroutable requests) are raised right away
+# {args} request: function(client, ...), *args
+# {returns} response of request
+def with_retries(request, *args, **kwargs):
+    for attempt in range(ORS_RETRIES + 1):
+        try:
+            return request(ors_client(), *args, **kwargs)
+        except (ConnectionError, exceptions.Timeout, exceptions.HTTPError, exceptions.ApiError) as err:
+            if attempt == ORS_RETRIES or not is_transient(err):
+                raise
+            wait = ORS_BACKOFF * 2 ** attempt * (0.5 + random())
+            print(f'ors request failed ({err!r}), retrying in {wait:.1f}s...')
+            sleep(wait)
+
+
+# {args} coords: ((lon, lat), (lon, lat)), profile: str
+# {returns} directions response
+def ors_directions(coords, profile):
+    return with_retries(directions, coords, profile)
+
+
+# {args} locations: [(lon, lat)], profile: str, sources: [int], destinations: [int]
+# {returns} matrix response
+def ors_matrix(locations, profile, sources, destinations):
+    return with_retries(distance_matrix, locations, profile, sources=sources, destinations=destinations,
+                        metrics=['duration'])
@@ -1,14 +1,19 @@
 from pandas import Timedelta
-from openrouteservice import Client, exceptions
-from openrouteservice.directions import directions
+from openrouteservice import exceptions
 
-local_client = Client(base_url='http://localhost:8082/ors')
+from scripts.routing.ors_client import ors_directions, ors_matrix, ors_map, is_transient, is_unroutable, \
+    ORS_CONCURRENCY
+from scripts.routing.duration_cache import duration_key, get_cached_durations, cache_durations
+
+# largest number of routes (sources x destinations) in one matrix request, ors setting matrix.maximum_routes
+MATRIX_MAX_ROUTES = 2500
 
 
 # request route, get duration of car/walking trip
-# {args} start_point: Point, end_point: Point, profile: string, is_point_obj: boolean
+# network 'ors' requests the local ors server, 'osm' routes on the graph of the osm extract containing both points
+# {args} start_point: Point, end_point: Point, profile: string, is_point_obj: boolean, network: str
 # {returns} Timedelta
-def get_ors_duration(start_point, end_point, profile, is_point_obj=True):
+def get_ors_duration(start_point, end_point, profile, is_point_obj=True, network='ors'):
     if is_point_obj:
         start = (start_point.x, start_point.y)
         end = (end_point.x, end_point.y)
@@ -17,42 +22,229 @@ def get_ors_duration(start_point, end_point, profile, is_point_obj=True):
         end = end_point
     coords = (start, end)
 
+    if network == 'osm':
+        # osm routing needs osmium and scipy, they are only imported if the osm network is used
+        from scripts.routing.osm_routing import get_osm_matrix
+        return get_osm_matrix([start], [end], profile)[0][0]
+
+    key = duration_key(start, end, profile)
+    cached = get_cached_durations([key])
+    if key in cached:
+        return cached[key]
+
     try:
-        query = directions(local_client, coords, profile)
+        duration = request_ors_duration(coords, profile)
+    except exceptions.ApiError as err:
+        if is_transient(err):
+            raise
+        # ors rejected the request without saying that there is no route, the duration is requested again next time
+        print(f'no ors duration: {err}')
+        return None
+    cache_durations({key: duration})
+    return duration
+
+
+# request duration of car/walking trip from ors, without looking at the duration cache
+# ApiErrors other than an unroutable trip are raised
+# {args} coords: ((lon, lat), (lon, lat)), profile: string
+# {returns} Timedelta, or None if ors found no route
+def request_ors_duration(coords, profile):
+    try:
+        query = ors_directions(coords, profile)
         dur = query["routes"][0]["summary"]["duration"]  # in seconds
         return Timedelta(dur, 's')
     except exceptions.ApiError as err:
+        if not is_unroutable(err):
+            raise
         print(f'no ors duration routable: {err}')
         return None
 
 
+# request duration of one trip, ApiErrors of trips ors rejected without saying that there is no route are returned
+# {args} job: ((lon, lat), (lon, lat), profile)
+# {returns} Timedelta, None if ors found no route, or the ApiError
+def request_ors_job(job):
+    try:
+        return request_ors_duration(job[:2], job[2])
+    except exceptions.ApiError as err:
+        if is_transient(err):
+            raise
+        print(f'no ors duration: {err}')
+        return err
+
+
+# get durations of many trips, trips missing in the duration cache are requested from ors concurrently
+# rejected trips get the duration None and are not cached
+# {args} jobs: [((lon, lat), (lon, lat), profile)], concurrency: int
+# {returns} list of Timedeltas in the order of jobs
+def get_ors_durations_bulk(jobs, concurrency=ORS_CONCURRENCY):
+    keys = [duration_key(start, end, profile) for start, end, profile in jobs]
+    cached = get_cached_durations(keys)
+
+    jobs_by_key = dict(zip(keys, jobs))
+    missing = [key for key in jobs_by_key if key not in cached]
+    requested = dict(zip(missing, ors_map(request_ors_job, [jobs_by_key[key] for key in missing], concurrency)))
+    cache_durations({key: duration for key, duration in requested.items()
+                     if not isinstance(duration, exceptions.ApiError)})
+    cached.update({key: None if isinstance(duration, exceptions.ApiError) else duration
+                   for key, duration in requested.items()})
+
+    return [cached[key] for key in keys]
+
+
 # get time it takes to walk from start point to departure station and from arrival station to cinema
-# {args} route_df: df, start_point: Point, cinema_location: Point, gtfs_df: df
+# walks found in the precomputed tables of get_walks_to_stations and get_walks_from_stations are not requested again
+# {args} route_df: df, start_point: Point, cinema_location: Point, gtfs_df: df, walks_to: dict, walks_from: dict,
+# network: str
 # {returns} list of Timedeltas
-def get_walk_to_station(route_df, start_point, cinema_location, gtfs_df):
+def get_walk_to_station(route_df, start_point, cinema_location, gtfs_df, walks_to=None, walks_from=None,
+                        network='ors'):
     if route_df is None:
         return None
 
-    stops = gtfs_df['stops']
-
     dep_name = route_df['stop_name'].iloc[0]
     arr_name = route_df['stop_name'].iloc[len(route_df) - 1]
-    dep_stop = stops[stops['stop_name'] == dep_name].iloc[0]
-    arr_stop = stops[stops['stop_name'] == arr_name].iloc[0]
-    dep_point = (dep_stop.stop_lon, dep_stop.stop_lat)
-    arr_point = (arr_stop.stop_lon, arr_stop.stop_lat)
 
-    dep_dur = get_ors_duration((start_point.x, start_point.y), dep_point, 'foot-walking', False)
-    arr_dur = get_ors_duration(arr_point, (cinema_location.x, cinema_location.y), 'foot-walking', False)
+    if walks_to is not None and dep_name in walks_to:
+        dep_dur = walks_to[dep_name]
+    else:
+        dep_point = stop_coords(gtfs_df, [dep_name])[0]
+        dep_dur = get_ors_duration((start_point.x, start_point.y), dep_point, 'foot-walking', False, network)
+    if walks_from is not None and arr_name in walks_from:
+        arr_dur = walks_from[arr_name]
+    else:
+        arr_point = stop_coords(gtfs_df, [arr_name])[0]
+        arr_dur = get_ors_duration(arr_point, (cinema_location.x, cinema_location.y), 'foot-walking', False,
+                                   network)
 
     return [dep_dur, arr_dur]
 
 
-# {args} start: Point, destinations: dataframe, profile: string
+# get coordinates of the first stop with each name, the stop walks to and from stations are calculated for
+# {args} gtfs_df: df, stop_names: [str]
+# {returns} list of (lon, lat)
+def stop_coords(gtfs_df, stop_names):
+    stops = gtfs_df['stops'].drop_duplicates('stop_name').set_index('stop_name')
+    coords = stops.loc[list(stop_names), ['stop_lon', 'stop_lat']]
+
+    return list(coords.itertuples(index=False, name=None))
+
+
+# get walks from a start point to all of its closest stations with one matrix request
+# {args} start_point: Point, stations: df, gtfs_df: df, network: str
+# {returns} dict of stop_name: Timedelta
+def get_walks_to_stations(start_point, stations, gtfs_df, network='ors'):
+    names = list(dict.fromkeys(stations['stop_name']))
+    walks = get_ors_matrix([(start_point.x, start_point.y)], stop_coords(gtfs_df, names), 'foot-walking',
+                           network)[0]
+
+    return dict(zip(names, walks))
+
+
+# get walks from all closest stations of a cinema to the cinema with one matrix request
+# {args} stations: df, cinema_location: Point, gtfs_df: df, network: str
+# {returns} dict of stop_name: Timedelta
+def get_walks_from_stations(stations, cinema_location, gtfs_df, network='ors'):
+    names = list(dict.fromkeys(stations['stop_name']))
+    walks = get_ors_matrix(stop_coords(gtfs_df, names), [(cinema_location.x, cinema_location.y)], 'foot-walking',
+                           network)
+
+    return dict(zip(names, [walk[0] for walk in walks]))
+
+
+# get durations from all starts to all ends, from the duration cache or the ors matrix endpoint
+# only starts and ends with durations missing in the cache are requested, network 'osm' routes on the osm extracts
+# {args} starts: [(lon, lat)], ends: [(lon, lat)], profile: string, network: str
+# {returns} list (one per start) of lists of Timedeltas
+def get_ors_matrix(starts, ends, profile, network='ors'):
+    if network == 'osm':
+        from scripts.routing.osm_routing import get_osm_matrix
+        return get_osm_matrix(starts, ends, profile)
+
+    keys = [[duration_key(start, end, profile) for end in ends] for start in starts]
+    cached = get_cached_durations([key for row in keys for key in row])
+
+    missing_starts = [sid for sid, row in enumerate(keys) if any(key not in cached for key in row)]
+    missing_ends = sorted({eid for sid in missing_starts for eid, key in enumerate(keys[sid]) if key not in cached})
+    if missing_starts:
+        requested, failed = request_ors_matrix([starts[sid] for sid in missing_starts],
+                                               [ends[eid] for eid in missing_ends], profile)
+        new = {keys[sid][eid]: requested[i][j]
+               for i, sid in enumerate(missing_starts) for j, eid in enumerate(missing_ends)}
+        # durations of trips ors rejected without saying there is no route are not cached
+        unknown = {keys[missing_starts[i]][missing_ends[j]] for i, j in failed}
+        cache_durations({key: duration for key, duration in new.items() if key not in unknown})
+        cached.update(new)
+
+    return [[cached[key] for key in row] for row in keys]
+
+
+# request durations from all starts to all ends with the ors matrix endpoint, in blocks of at most MATRIX_MAX_ROUTES
+# the blocks are requested concurrently, the trips of blocks the matrix endpoint cannot route are then requested
+# concurrently from the directions endpoint, server errors left after all retries are raised
+# {args} starts: [(lon, lat)], ends: [(lon, lat)], profile: string, concurrency: int
+# {returns} list [durations: list (one per start) of lists of Timedeltas, failed: set of (start index, end index) of
+# trips ors rejected without saying that there is no route, their durations are None]
+def request_ors_matrix(starts, ends, profile, concurrency=ORS_CONCURRENCY):
+    durations = [[None] * len(ends) for _ in starts]
+    failed = set()
+    if len(starts) == 0 or len(ends) == 0:
+        return [durations, failed]
+
+    end_chunk = min(len(ends), MATRIX_MAX_ROUTES)
+    start_chunk = max(1, MATRIX_MAX_ROUTES // end_chunk)
+    blocks = [(first_start, first_end) for first_start in range(0, len(starts), start_chunk)
+              for first_end in range(0, len(ends), end_chunk)]
+
+    # {args} block: (first start, first end)
+    # {returns} list of lists of Timedeltas, None if the matrix endpoint rejected the block
+    def request_block(block):
+        block_starts = list(starts[block[0]:block[0] + start_chunk])
+        block_ends = list(ends[block[1]:block[1] + end_chunk])
+        try:
+            query = ors_matrix(block_starts + block_ends, profile, list(range(len(block_starts))),
+                               list(range(len(block_starts), len(block_starts) + len(block_ends))))
+            return [[Timedelta(dur, 's') if dur is not None else None for dur in row] for row in query['durations']]
+        except exceptions.ApiError as err:
+            if is_transient(err):
+                raise
+            print(f'no ors matrix routable, requesting directions: {err}')
+            return None
+
+    pairs = []
+    for (first_start, first_end), block in zip(blocks, ors_map(request_block, blocks, concurrency)):
+        if block is None:
+            pairs += [(sid, eid) for sid in range(first_start, min(first_start + start_chunk, len(starts)))
+                      for eid in range(first_end, min(first_end + end_chunk, len(ends)))]
+            continue
+        for sid, row in enumerate(block):
+            durations[first_start + sid][first_end:first_end + len(row)] = row
+
+    jobs = [(starts[sid], ends[eid], profile) for sid, eid in pairs]
+    for (sid, eid), duration in zip(pairs, ors_map(request_ors_job, jobs, concurrency)):
+        if isinstance(duration, exceptions.ApiError):
+            failed.add((sid, eid))
+            duration = None
+        durations[sid][eid] = duration
+
+    return [durations, failed]
+
+
+# {args} start: Point, destinations: dataframe, profile: string, batched: boolean, network: str
 # {returns} list of Timedeltas
-def get_all_ors_durations(start, destinations, profile):
-    durations = []
-    for pid, poi in destinations.iterrows():
-        durations.append(get_ors_duration(start, poi['geometry'], profile))
+def get_all_ors_durations(start, destinations, profile, batched=True, network='ors'):
+    if batched:
+        ends = [(poi.x, poi.y) for poi in destinations['geometry']]
+        return get_ors_matrix([(start.x, start.y)], ends, profile, network)[0]
+
+    if network == 'osm':
+        return [get_ors_duration(start, poi, profile, network=network) for poi in destinations['geometry']]
+    return get_ors_durations_bulk([((start.x, start.y), (poi.x, poi.y), profile) for poi in destinations['geometry']])
+
 
-    return durations
+# get durations from several start points to all destinations with as few matrix requests as possible
+# {args} starts: series of Points, destinations: dataframe, profile: string, network: str
+# {returns} list (one per start) of lists of Timedeltas
+def get_all_ors_durations_many(starts, destinations, profile, network='ors'):
+    ends = [(poi.x, poi.y) for poi in destinations['geometry']]
+    return get_ors_matrix([(start.x, start.y) for start in starts], ends, profile, network)
@@ -0,0 +1,275 @@
+from os import path, listdir
+from numpy import (array, arange, asarray, concatenate, cumsum, bincount, lexsort, unique, ones, maximum, isinf,
+                   column_stack, repeat, int64, float64)
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from pandas import Timedelta
+
+from scripts.utils import haversine_distance, get_transformer, feed_hash, timetable_cache_folder
+from scripts.routing.timetable_cache import save_timetable, load_timetable
+
+# folder of the osm extracts written by the commands of generate_extract_commands.osmium_command
+OSM_PATH = 'osm_files'
+# speeds in km/h by highway tag for cars, ways with other highway tags are not driveable
+CAR_SPEEDS = {'motorway': 100, 'motorway_link': 60, 'trunk': 85, 'trunk_link': 60, 'primary': 65,
+              'primary_link': 50, 'secondary': 60, 'secondary_link': 50, 'tertiary': 50, 'tertiary_link': 40,
+              'unclassified': 30, 'residential': 30, 'living_street': 10, 'service': 20, 'road': 20}
+# walking speed in km/h, used on all ways with a highway tag except the ones in NOT_WALKABLE
+FOOT_SPEED = 5
+NOT_WALKABLE = ['motorway', 'motorway_link', 'trunk', 'trunk_link', 'construction', 'proposed', 'raceway',
+                'bus_guideway', 'abandoned', 'platform']
+# version of the graphs built from the osm extracts, part of their cache file names
+# increase it whenever osm_graph or way_speed build them differently, so graphs of older versions are not loaded
+GRAPH_FORMAT = 1
+# speeds in km/h routes are assumed to reach at least on the straight line to their end, they bound the first search
+# from a source, targets not reached within that time are searched again with a doubled bound
+BOUND_SPEEDS = {'driving-car': 30, 'foot-walking': FOOT_SPEED / 2}
+# number of sources routed by one dijkstra call, each source needs a row of distances to all nodes in memory
+DIJKSTRA_CHUNK = 16
+# bounding boxes of the osm extracts and graphs loaded in this process
+EXTRACT_BOXES = {}
+GRAPHS = {}
+
+
+# get speed of a way and in which directions it can be used with a profile
+# {args} tags: osmium TagList, profile: str ('driving-car' or 'foot-walking')
+# {returns} list [speed in m/s, forward: boolean, backward: boolean], speed is 0 if the way cannot be used
+def way_speed(tags, profile):
+    highway = tags.get('highway')
+    access = tags.get('access')
+
+    if profile == 'foot-walking':
+        foot = tags.get('foot')
+        if highway in NOT_WALKABLE and foot not in ['yes', 'designated']:
+            return [0, False, False]
+        if foot == 'no' or (access in ['no', 'private'] and foot not in ['yes', 'designated', 'permissive']):
+            return [0, False, False]
+        return [FOOT_SPEED / 3.6, True, True]
+
+    if highway not in CAR_SPEEDS or access in ['no', 'private'] or \
+            tags.get('motor_vehicle') == 'no' or tags.get('motorcar') == 'no':
+        return [0, False, False]
+
+    speed = CAR_SPEEDS[highway]
+    maxspeed = tags.get('maxspeed', '')
+    if maxspeed.isdigit():
+        speed = min(speed, int(maxspeed)) if highway in ['living_street', 'service'] else int(maxspeed)
+
+    oneway = tags.get('oneway')
+    if oneway in ['yes', 'true', '1'] or (oneway is None and (highway in ['motorway', 'motorway_link'] or
+                                                               tags.get('junction') == 'roundabout')):
+        return [speed / 3.6, True, False]
+    elif oneway == '-1':
+        return [speed / 3.6, False, True]
+    return [speed / 3.6, True, True]
+
+
+# read the road network of an osm extract into a graph in compressed sparse row format
+# {args} pbf_file: str, profile: str
+# {returns} dict of arrays (node lon/lat, edges of node i are to[indptr[i]:indptr[i+1]] with durations dur in seconds)
+def osm_graph(pbf_file, profile):
+    # osmium is only needed to read extracts, graphs in the feed cache are loaded without it
+    import osmium
+
+    refs = []
+    lon = []
+    lat = []
+    way_start = []
+    way_length = []
+    way_speeds = []
+    forward = []
+    backward = []
+    for way in osmium.FileProcessor(pbf_file, osmium.osm.NODE | osmium.osm.WAY).with_locations():
+        if not way.is_way() or 'highway' not in way.tags or len(way.nodes) < 2:
+            continue
+        speed, fwd, bwd = way_speed(way.tags, profile)
+        if speed == 0:
+            continue
+
+        way_start.append(len(refs))
+        way_length.append(len(way.nodes))
+        way_speeds.append(speed)
+        forward.append(fwd)
+        backward.append(bwd)
+        for node in way.nodes:
+            refs.append(node.ref)
+            lon.append(node.lon)
+            lat.append(node.lat)
+
+    # nodes shared by several ways are the same graph node
+    node_ids, first, nodes = unique(asarray(refs, dtype=int64), return_index=True, return_inverse=True)
+    node_lon = asarray(lon, dtype=float64)[first]
+    node_lat = asarray(lat, dtype=float64)[first]
+
+    # one segment per pair of consecutive nodes of a way, the last node of a way starts no segment
+    way_length = asarray(way_length, dtype=int64)
+    segment_way = repeat(arange(len(way_length)), way_length - 1)
+    starts_segment = ones(max(len(refs) - 1, 0), dtype=bool)
+    starts_segment[(asarray(way_start, dtype=int64) + way_length - 1)[:-1]] = False
+    segment_start = starts_segment.nonzero()[0]
+    seg_from = nodes[segment_start]
+    seg_to = nodes[segment_start + 1]
+    seg_dur = haversine_distance(node_lon[seg_from], node_lat[seg_from], node_lon[seg_to], node_lat[seg_to]) / \
+        asarray(way_speeds)[segment_way]
+    # csgraph ignores edges with a duration of 0
+    seg_dur = maximum(seg_dur, 0.001)
+
+    fwd = asarray(forward, dtype=bool)[segment_way]
+    bwd = asarray(backward, dtype=bool)[segment_way]
+    from_nodes = concatenate([seg_from[fwd], seg_to[bwd]])
+    to_nodes = concatenate([seg_to[fwd], seg_from[bwd]])
+    durations = concatenate([seg_dur[fwd], seg_dur[bwd]])
+
+    # keep the fastest of parallel edges, sorted by from node for the csr format
+    order = lexsort((durations, to_nodes, from_nodes))
+    from_nodes, to_nodes, durations = from_nodes[order], to_nodes[order], durations[order]
+    keep = ones(len(order), dtype=bool)
+    keep[1:] = (from_nodes[1:] != from_nodes[:-1]) | (to_nodes[1:] != to_nodes[:-1])
+    from_nodes, to_nodes, durations = from_nodes[keep], to_nodes[keep], durations[keep]
+
+    indptr = concatenate([array([0]), cumsum(bincount(from_nodes, minlength=len(node_ids)))])
+
+    return {'lon': node_lon, 'lat': node_lat, 'indptr': indptr, 'to': to_nodes, 'dur': durations}
+
+
+# get graph of an osm extract from memory, the feed cache or by reading the extract, with a kd-tree for snapping
+# {args} pbf_file: str, profile: str
+# {returns} dict
+def load_osm_graph(pbf_file, profile):
+    key = (pbf_file, profile)
+    if key not in GRAPHS:
+        name = path.basename(pbf_file).split('.', 1)[0]
+        cache_file = path.join(timetable_cache_folder(pbf_file), f'{name}_{profile}_v{GRAPH_FORMAT}_'
+                                                                     f'{feed_hash(pbf_file)}.npz')
+        if path.isfile(cache_file):
+            graph = load_timetable(cache_file)
+        else:
+            print(f'building {profile} graph of {pbf_file}...')
+            graph = osm_graph(pbf_file, profile)
+            save_timetable(graph, cache_file)
+
+        size = len(graph['lon'])
+        graph['matrix'] = csr_matrix((graph['dur'], graph['to'], graph['indptr']), shape=(size, size))
+        # reversed graph for routing from the ends, if they are fewer than the starts
+        graph['reversed'] = graph['matrix'].T.tocsr()
+        # only nodes that can be left and reached are used as start and end of routes
+        out_degree = graph['indptr'][1:] - graph['indptr'][:-1]
+        in_degree = bincount(graph['to'], minlength=size)
+        graph['snap_nodes'] = ((out_degree > 0) & (in_degree > 0)).nonzero()[0]
+        x, y = get_transformer(4326, 25832).transform(graph['lon'][graph['snap_nodes']],
+                                                      graph['lat'][graph['snap_nodes']])
+        graph['tree'] = cKDTree(column_stack([x, y]))
+        GRAPHS[key] = graph
+
+    return GRAPHS[key]
+
+
+# get bounding box of an osm extract from its header
+# {args} pbf_file: str
+# {returns} list [min lon, min lat, max lon, max lat] or None
+def extract_box(pbf_file):
+    if pbf_file not in EXTRACT_BOXES:
+        import osmium
+        reader = osmium.io.Reader(pbf_file, osmium.osm.NOTHING)
+        box = reader.header().box()
+        reader.close()
+        EXTRACT_BOXES[pbf_file] = [box.bottom_left.lon, box.bottom_left.lat, box.top_right.lon,
+                                   box.top_right.lat] if box.valid() else None
+
+    return EXTRACT_BOXES[pbf_file]
+
+
+# find the osm extract containing all points
+# {args} points: [(lon, lat)]
+# {returns} str
+def find_extract(points):
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    for file in sorted(listdir(OSM_PATH)):
+        if not file.endswith('-extract.osm.pbf'):
+            continue
+        box = extract_box(path.join(OSM_PATH, file))
+        if box is not None and box[0] <= min(lons) and max(lons) <= box[2] and box[1] <= min(lats) and \
+                max(lats) <= box[3]:
+            return path.join(OSM_PATH, file)
+
+    raise Exception(f'there is no osm extract in {OSM_PATH} containing all points')
+
+
+# get the closest graph node of each point
+# {args} graph: dict, points: [(lon, lat)]
+# {returns} array of node indices
+def snap_to_graph(graph, points):
+    x, y = get_transformer(4326, 25832).transform([point[0] for point in points],
+                                                  [point[1] for point in points])
+    return graph['snap_nodes'][graph['tree'].query(column_stack([x, y]))[1]]
+
+
+# get durations from sources to targets with dijkstra searches that stop at a time limit instead of visiting the whole
+# graph, the limit starts at the straight line distance to the farthest target at BOUND_SPEEDS and is doubled until all
+# targets are reached or no more nodes can be reached
+# {args} graph: dict, matrix: csr_matrix, sources: array of nodes, targets: array of nodes, profile: str
+# {returns} array (one row per source) of durations in seconds to the targets, inf if not reachable
+def bounded_dijkstra(graph, matrix, sources, targets, profile):
+    distance = haversine_distance(graph['lon'][sources][:, None], graph['lat'][sources][:, None],
+                                  graph['lon'][targets][None, :], graph['lat'][targets][None, :])
+    limit = max(float(distance.max()), 1.0) / (BOUND_SPEEDS[profile] / 3.6)
+
+    while True:
+        seconds = dijkstra(matrix, indices=sources, limit=limit)
+        if not isinf(seconds[:, targets]).any():
+            return seconds[:, targets]
+        # the missing targets are not reachable if no edge leads from a reached node to a node beyond the limit
+        reached = ~isinf(seconds)
+        if not ((matrix.T @ reached.T.astype(float64)) > 0).T[~reached].any():
+            return seconds[:, targets]
+        limit *= 2
+
+
+# get durations from all starts to all ends on the network of the osm extract containing them
+# dijkstra runs from the smaller side, from several sources at once, on the reversed graph if the ends are fewer
+# {args} starts: [(lon, lat)], ends: [(lon, lat)], profile: string
+# {returns} list (one per start) of lists of Timedeltas
+def get_osm_matrix(starts, ends, profile):
+    if len(starts) == 0 or len(ends) == 0:
+        return [[None] * len(ends) for _ in starts]
+
+    graph = load_osm_graph(find_extract(list(starts) + list(ends)), profile)
+    start_nodes = snap_to_graph(graph, starts)
+    end_nodes = snap_to_graph(graph, ends)
+
+    reverse = len(unique(start_nodes)) > len(unique(end_nodes))
+    if reverse:
+        matrix, sources, targets = graph['reversed'], end_nodes, start_nodes
+    else:
+        matrix, sources, targets = graph['matrix'], start_nodes, end_nodes
+
+    unique_sources, source_rows = unique(sources, return_inverse=True)
+    seconds = concatenate([bounded_dijkstra(graph, matrix, unique_sources[i:i + DIJKSTRA_CHUNK], targets, profile)
+                           for i in range(0, len(unique_sources), DIJKSTRA_CHUNK)])[source_rows]
+    if reverse:
+        seconds = seconds.T
+
+    return [[None if isinf(dur) else Timedelta(dur, 's') for dur in row] for row in seconds]
+
+
+# get duration of car/walking trip on the network of the osm extracts
+# {args} start_point: Point, end_point: Point, profile: string, is_point_obj: boolean
+# {returns} Timedelta
+def get_osm_duration(start_point, end_point, profile, is_point_obj=True):
+    if is_point_obj:
+        start = (start_point.x, start_point.y)
+        end = (end_point.x, end_point.y)
+    else:
+        start = start_point
+        end = end_point
+
+    return get_osm_matrix([start], [end], profile)[0][0]
+
+
+# {args} start: Point, destinations: dataframe, profile: string
+# {returns} list of Timedeltas
+def get_all_osm_durations(start, destinations, profile):
+    ends = [(poi.x, poi.y) for poi in destinations['geometry']]
+    return get_osm_matrix([(start.x, start.y)], ends, profile)[0]
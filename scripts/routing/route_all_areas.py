@@ -1,19 +1,19 @@
 from os import path, makedirs
-from pandas import concat, read_csv
+from pandas import concat
 from geopandas import read_file
 
-from scripts.utils import remove_dir
 from scripts.constants import RESULTS_PATH, SELECTED
 from scripts.get_osm_data import get_random_start, bbox_edge_coords
-from scripts.routing.calculate_routes import get_routes
+from scripts.routing.calculate_routes import get_routes, routing_pool
 
 
-# calculate routes for all start points in an area in batches
-# {args} area_name: str, full_gtfs: str, times: [int], batch_count: int, weekday: str, date: str
+# calculate routes for all start points in an area, batch_count batches of 10 start points
+# all start points are routed in one map over the worker pool, so all workers are busy until the area is done
+# {args} area_name: str, full_gtfs: str, times: [int], batch_count: int, weekday: str, date: str, backend: str,
+# workers: int, network: str, pool: ProcessPoolExecutor from routing_pool or None
 # {returns} None, writes gpkg and csv file
-def batch_route_for_times(area_name, full_gtfs, times, batch_count, weekday, date='20240309'):
-    folder = path.join(RESULTS_PATH, f'{area_name}_batch')
-    makedirs(folder, exist_ok=True)
+def batch_route_for_times(area_name, full_gtfs, times, batch_count, weekday, date='20240309', backend='gtfsrouter',
+                          workers=1, network='ors', pool=None):
     makedirs(path.join(RESULTS_PATH, 'routes', area_name), exist_ok=True)
 
     start_count = batch_count*10
@@ -28,26 +28,9 @@ def batch_route_for_times(area_name, full_gtfs, times, batch_count, weekday, dat
         all_centres = get_random_start(area_name, start_count)
         all_centres.to_file(expected_starts)
 
-    # slice centres into batches of 10 start points
-    def slice_start(i):
-        from_point = i*10
-        return all_centres[from_point:from_point+10]
-    centres = [slice_start(i) for i in range(batch_count)]
-
-    # calculate routes for a batch of 10 start points at a time and write filename of batch results to this list
-    files = [get_routes(area_name, full_gtfs, times, centres[i], weekday, i, '20240309') for i in range(batch_count)]
-
-    # read each batch results into a list of (geo)dataframes
-    gdfs = [read_file(path.join(RESULTS_PATH, f'{area_name}_batch', f'{file}.gpkg')) for file in files]
-    dfs = [read_csv(path.join(RESULTS_PATH, f'{area_name}_batch', f'{file}.csv')) for file in files]
-
-    # concatenate the batch results into one file containing all results for the area
-    time_str = '-'.join([str(t) for t in times])
-    concat(gdfs).to_file(path.join(RESULTS_PATH, 'geo_data', f'{area_name}_{time_str}_{weekday}_{batch_count*10}.gpkg'))
-    concat(dfs).to_csv(path.join(RESULTS_PATH, f'{area_name}_{time_str}_{weekday}_{batch_count*10}.csv'))
-
-    # remove batch files once they have been concatenated
-    remove_dir(folder)
+    # results of all start points are written to one file for the area
+    get_routes(area_name, full_gtfs, times, all_centres[:start_count], weekday, 'all', '20240309', backend, workers,
+               network, pool)
 
 
 # concatenate results for randomly selected start points and edge start points
@@ -70,9 +53,11 @@ def concat_corners(level, timesdate):
 
 
 # calculate routes for start points closest to bbox boundaries
-# {args} full_gtfs: str, level: str, times: [int], weekday: str, date: str
+# {args} full_gtfs: str, level: str, times: [int], weekday: str, date: str, backend: str, workers: int, network: str,
+# pool: ProcessPoolExecutor from routing_pool or None
 # {returns} None, writes gpkg and csv file
-def add_corners_for_times(area_name, full_gtfs, times, weekday, date='20240309'):
+def add_corners_for_times(area_name, full_gtfs, times, weekday, date='20240309', backend='gtfsrouter', workers=1,
+                          network='ors', pool=None):
     time_str = '-'.join([str(t) for t in times])
 
     # if edge points have already been selected read them from file, if not then make selection here
@@ -87,7 +72,7 @@ def add_corners_for_times(area_name, full_gtfs, times, weekday, date='20240309')
     output_path = path.join(RESULTS_PATH, f'{area_name}_{time_str}_{weekday}_4.csv')
     if not path.isfile(output_path):
         print(f'{output_path} does not exist')
-        get_routes(area_name, full_gtfs, times, centres, weekday, 'bbox', '20240309')
+        get_routes(area_name, full_gtfs, times, centres, weekday, 'bbox', '20240309', backend, workers, network, pool)
     print(f'{area_name} done!')
 
 
@@ -95,10 +80,21 @@ if __name__ == "__main__":
     for centrality in ['top', 'mid', 'base']:
         gtfs_filename = 'opnv_240218'
         start_times = [15, 18, 21]
+        # 'gtfsrouter' routes through R, 'csa' uses the python connection scan and 'csa_profile' the python profile
+        # scan, which answers any number of start times for almost the cost of one
+        routing_backend = 'gtfsrouter'
+        # number of processes routing start points in parallel
+        routing_workers = 1
+        # 'ors' gets car and foot durations from the local ors server, 'osm' routes on the osm extracts in osm_files
+        duration_network = 'ors'
 
         for name in SELECTED[centrality]:
             print(name)
-            batch_route_for_times(name, gtfs_filename, start_times, 10, 'Sat')
-            add_corners_for_times(name, gtfs_filename, start_times, 'Sat')
+            # one pool per area, its workers keep the timetable of the area for all start points
+            with routing_pool(routing_workers) as area_pool:
+                batch_route_for_times(name, gtfs_filename, start_times, 10, 'Sat', backend=routing_backend,
+                                      workers=routing_workers, network=duration_network, pool=area_pool)
+                add_corners_for_times(name, gtfs_filename, start_times, 'Sat', backend=routing_backend,
+                                      workers=routing_workers, network=duration_network, pool=area_pool)
 
         concat_corners(centrality, '15-18-21_Sat')
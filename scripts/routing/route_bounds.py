@@ -0,0 +1,60 @@
+from numpy import asarray, maximum, isnan
+
+from scripts.utils import gtfs_time_to_seconds, haversine_distance, zip_to_df
+
+# upper bound of the ors foot-walking speed in m/s (ors walks at 5 km/h)
+WALK_SPEED_BOUND = 5 / 3.6
+# routes may start and end at any stop within transfer distance (d_limit) of the chosen stations
+TRANSFER_SLACK = 200
+# fastest speed of any vehicle in m/s (300 km/h), faster hops between two stops come from misplaced stops
+MAX_TRANSIT_SPEED = 300 / 3.6
+
+
+# get the speed of the fastest vehicles between two consecutive stops in the feed
+# the speed has to be a maximum, so the lower bounds of duration_lower_bounds never prune the fastest route
+# one misplaced stop gives speeds of hundreds of m/s on all its hops, hops faster than MAX_TRANSIT_SPEED are ignored
+# times are given in minutes, so connections are assumed to take at least one minute
+# {args} zip_file: str
+# {returns} float
+def network_max_speed(zip_file):
+    gtfs_df = zip_to_df(zip_file, ['stops', 'stop_times'])
+    stop_times = gtfs_df['stop_times'].sort_values(['trip_id', 'stop_sequence'])
+    stops = gtfs_df['stops'][['stop_id', 'stop_lon', 'stop_lat']].drop_duplicates('stop_id')
+    stop_times = stop_times.merge(stops, how='left', on='stop_id')
+
+    trip = stop_times['trip_id'].to_numpy()
+    lon = stop_times['stop_lon'].to_numpy(dtype=float)
+    lat = stop_times['stop_lat'].to_numpy(dtype=float)
+    departure = gtfs_time_to_seconds(stop_times['departure_time'])
+    arrival = gtfs_time_to_seconds(stop_times['arrival_time'])
+
+    # hops from or to stops without times have no duration
+    same_trip = (trip[:-1] == trip[1:]) & (departure[:-1] >= 0) & (arrival[1:] >= 0)
+    distance = haversine_distance(lon[:-1], lat[:-1], lon[1:], lat[1:])[same_trip]
+    duration = maximum(arrival[1:] - departure[:-1], 60)[same_trip]
+    speeds = distance / duration
+    # hops at stops without coordinates have no speed
+    speeds = speeds[~isnan(speeds) & (speeds <= MAX_TRANSIT_SPEED)]
+    if len(speeds) == 0:
+        return MAX_TRANSIT_SPEED
+
+    return float(speeds.max())
+
+
+# get a lower bound of the total duration via each start stop: walk there, ride in a straight line at the fastest
+# speed of the network to one of the cinema's stations and walk to the cinema
+# {args} start: df of stations, start_point: Point, end: df of stations, cinema_location: Point, max_speed: float
+# {returns} array of seconds, one per start stop
+def duration_lower_bounds(start, start_point, end, cinema_location, max_speed):
+    start_lon = asarray(start['stop_lon'], dtype=float)
+    start_lat = asarray(start['stop_lat'], dtype=float)
+    end_lon = asarray(end['stop_lon'], dtype=float)
+    end_lat = asarray(end['stop_lat'], dtype=float)
+
+    walk_to = haversine_distance(start_point.x, start_point.y, start_lon, start_lat) / WALK_SPEED_BOUND
+    ride = haversine_distance(start_lon[:, None], start_lat[:, None], end_lon[None, :], end_lat[None, :])
+    ride = maximum(ride - 2 * TRANSFER_SLACK, 0) / max_speed
+    walk_from = haversine_distance(end_lon, end_lat, cinema_location.x, cinema_location.y)
+    walk_from = maximum(walk_from - TRANSFER_SLACK, 0) / WALK_SPEED_BOUND
+
+    return walk_to + (ride + walk_from[None, :]).min(axis=1)
@@ -0,0 +1,71 @@
+from os import path, open as os_open, write, close, O_APPEND, O_CREAT, O_WRONLY
+from numpy import load
+
+from scripts.constants import RESULTS_PATH
+
+# keys of each memo file loaded in this process and the number of bytes read from the file so far
+MEMOS = {}
+
+
+# get path of the append-only file of a memo, one key per line
+# {args} name: str ('routes_not_possible' or 'routes_not_fast')
+# {returns} str
+def memo_path(name):
+    return path.join(RESULTS_PATH, f'{name}.txt')
+
+
+# write keys saved by earlier runs in numpy arrays into the memo file, only done if no memo file exists yet
+# {args} name: str
+# {returns} None, writes file
+def import_npy_memo(name):
+    npy_file = path.join(RESULTS_PATH, f'{name}.npy')
+    if path.isfile(npy_file) and not path.isfile(memo_path(name)):
+        keys = dict.fromkeys(str(key) for key in load(npy_file))
+        with open(memo_path(name), 'w', encoding='utf-8') as memo:
+            memo.writelines(f'{key}\n' for key in keys)
+        print(f'imported {len(keys)} keys from {npy_file}')
+
+
+# read lines appended to the memo file since it was last read, by this or any other process
+# {args} name: str
+# {returns} set of keys
+def refresh_memo(name):
+    if name not in MEMOS:
+        import_npy_memo(name)
+        MEMOS[name] = {'keys': set(), 'offset': 0}
+    memo = MEMOS[name]
+
+    if path.isfile(memo_path(name)) and path.getsize(memo_path(name)) > memo['offset']:
+        with open(memo_path(name), 'rb') as memo_file:
+            memo_file.seek(memo['offset'])
+            new = memo_file.read()
+        # a line another process is still writing is read next time
+        complete = new[:new.rfind(b'\n') + 1]
+        memo['keys'].update(complete.decode('utf-8').splitlines())
+        memo['offset'] += len(complete)
+
+    return memo['keys']
+
+
+# check if a key has been saved in a memo
+# {args} name: str, key: str
+# {returns} boolean
+def in_memo(name, key):
+    if name in MEMOS and key in MEMOS[name]['keys']:
+        return True
+    return key in refresh_memo(name)
+
+
+# save a key in a memo, the line is appended with a single write so concurrent processes do not mix lines
+# {args} name: str, key: str
+# {returns} None, appends to file
+def add_to_memo(name, key):
+    if in_memo(name, key):
+        return
+
+    memo_file = os_open(memo_path(name), O_WRONLY | O_APPEND | O_CREAT, 0o644)
+    try:
+        write(memo_file, f'{key}\n'.encode('utf-8'))
+    finally:
+        close(memo_file)
+    MEMOS[name]['keys'].add(key)
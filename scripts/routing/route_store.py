@@ -0,0 +1,97 @@
+from os import path, makedirs
+from sqlite3 import connect
+from pandas import Timedelta, read_sql_query
+
+from scripts.constants import RESULTS_PATH
+from scripts.routing.duration_cache import COORD_PRECISION
+
+# columns of gtfs route dataframes saved for every leg of a route
+LEG_COLUMNS = ['route_name', 'trip_name', 'stop_name', 'arrival_time', 'departure_time']
+
+
+# open (and create) the sqlite route store of an area, it holds the chosen routes with their durations
+# {args} area: str
+# {returns} sqlite connection
+def open_route_store(area):
+    makedirs(path.join(RESULTS_PATH, 'routes'), exist_ok=True)
+    # long timeout and write-ahead log, so several processes can use the same store
+    store = connect(path.join(RESULTS_PATH, 'routes', f'{area}.sqlite'), timeout=60)
+    store.execute('PRAGMA journal_mode=WAL')
+    store.execute('CREATE TABLE IF NOT EXISTS routes '
+                  '(route TEXT PRIMARY KEY, duration REAL, walk_from REAL, changes INTEGER)')
+    store.execute('CREATE TABLE IF NOT EXISTS walks '
+                  '(route TEXT, start TEXT, walk_to REAL, PRIMARY KEY (route, start))')
+    store.execute('CREATE TABLE IF NOT EXISTS legs (route TEXT, seq INTEGER, route_name TEXT, trip_name TEXT, '
+                  'stop_name TEXT, arrival_time TEXT, departure_time TEXT, PRIMARY KEY (route, seq))')
+    store.commit()
+
+    return store
+
+
+# get the key walks from a start point are saved with, start names are not unique within an area
+# {args} start_point: Point, precision: int
+# {returns} str of the rounded coordinates
+def start_key(start_point, precision=COORD_PRECISION):
+    return f'{round(start_point.x, precision)}_{round(start_point.y, precision)}'
+
+
+# {args} duration: Timedelta or None
+# {returns} float or None
+def to_seconds(duration):
+    return duration.total_seconds() if isinstance(duration, Timedelta) else None
+
+
+# {args} seconds: float or None
+# {returns} Timedelta or None
+def to_timedelta(seconds):
+    return Timedelta(seconds, 's') if seconds is not None else None
+
+
+# save a chosen route with its transit duration, walk from the arrival station and number of changes
+# {args} store: sqlite connection, route: str, route_df: df, duration: Timedelta, walk_from: Timedelta, changes: int
+# {returns} None, writes to store
+def save_route(store, route, route_df, duration, walk_from, changes):
+    legs = route_df.reindex(columns=LEG_COLUMNS).astype(str)
+    with store:
+        store.execute('INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)',
+                      (route, to_seconds(duration), to_seconds(walk_from), int(changes)))
+        store.execute('DELETE FROM legs WHERE route = ?', (route,))
+        store.executemany('INSERT INTO legs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          [(route, seq, *leg) for seq, leg in enumerate(legs.itertuples(index=False))])
+
+
+# save the walk from a start point to the departure station of a stored route
+# {args} store: sqlite connection, route: str, start: str from start_key, walk_to: Timedelta
+# {returns} None, writes to store
+def save_walk(store, route, start, walk_to):
+    if walk_to is not None:
+        with store:
+            store.execute('INSERT OR REPLACE INTO walks VALUES (?, ?, ?)', (route, start, to_seconds(walk_to)))
+
+
+# get transit duration, walk from the arrival station and number of changes of a stored route
+# {args} store: sqlite connection, route: str
+# {returns} dict or None
+def get_stored_route(store, route):
+    row = store.execute('SELECT duration, walk_from, changes FROM routes WHERE route = ?', (route,)).fetchone()
+    if row is None:
+        return None
+
+    return {'duration': to_timedelta(row[0]), 'walk_from': to_timedelta(row[1]), 'changes': row[2]}
+
+
+# get walk from a start point to the departure station of a stored route
+# {args} store: sqlite connection, route: str, start: str from start_key
+# {returns} Timedelta or None
+def get_stored_walk(store, route, start):
+    row = store.execute('SELECT walk_to FROM walks WHERE route = ? AND start = ?', (route, start)).fetchone()
+
+    return to_timedelta(row[0]) if row is not None else None
+
+
+# get the legs of a stored route
+# {args} store: sqlite connection, route: str
+# {returns} dataframe
+def get_stored_legs(store, route):
+    return read_sql_query(f'SELECT {", ".join(LEG_COLUMNS)} FROM legs WHERE route = ? ORDER BY seq', store,
+                          params=(route,))
@@ -0,0 +1,60 @@
+from os import path, makedirs, listdir, remove, replace, getpid
+from shutil import rmtree
+from numpy import load, savez
+
+from scripts.utils import feed_hash, timetable_cache_folder
+
+# version of the prepared timetables and transfer tables, part of their cache file names
+# increase it whenever they are built differently, so caches of older versions are not loaded
+TIMETABLE_FORMAT = 3
+
+
+# get path of the cached timetable for a feed, the name changes whenever the content of the zip archive or the
+# timetable format changes
+# {args} zip_file: str, weekday: str, d_limit: int, min_transfer_time: int, backend: str
+# {returns} str
+def timetable_cache_path(zip_file, weekday, d_limit, min_transfer_time, backend):
+    feed_name = path.basename(zip_file).rsplit('.', 1)[0]
+    extension = 'rds' if backend == 'gtfsrouter' else 'npz'
+    filename = (f'{feed_name}_{weekday}_{d_limit}_{min_transfer_time}_v{TIMETABLE_FORMAT}_{feed_hash(zip_file)}'
+                f'.{extension}')
+
+    return path.join(timetable_cache_folder(zip_file), filename)
+
+
+# write timetable of the python backend to an uncompressed npz archive
+# {args} timetable: dict of arrays, cache_file: str
+# {returns} None, writes file
+def save_timetable(timetable, cache_file):
+    makedirs(path.dirname(cache_file), exist_ok=True)
+    # object arrays would need pickling, store them as fixed width strings instead
+    arrays = {key: value.astype(str) if value.dtype == object else value for key, value in timetable.items()}
+
+    # write to temporary file first, so other processes never read a half written cache
+    tmp_file = f'{cache_file}.{getpid()}.tmp'
+    with open(tmp_file, 'wb') as cache:
+        savez(cache, **arrays)
+    replace(tmp_file, cache_file)
+
+
+# read timetable of the python backend from an npz archive
+# {args} cache_file: str
+# {returns} dict of arrays
+def load_timetable(cache_file):
+    with load(cache_file) as arrays:
+        return {key: arrays[key] for key in arrays.files}
+
+
+# delete all cached timetables and tables of a feed, called when the feed zip archive is rewritten
+# {args} zip_file: str
+# {returns} None, deletes files
+def clear_timetable_cache(zip_file):
+    folder = timetable_cache_folder(zip_file)
+    feed_name = path.basename(zip_file).rsplit('.', 1)[0]
+
+    if path.isdir(folder):
+        for file in listdir(folder):
+            if file.startswith(f'{feed_name}_') and path.isdir(path.join(folder, file)):
+                rmtree(path.join(folder, file))
+            elif file.startswith(f'{feed_name}_'):
+                remove(path.join(folder, file))
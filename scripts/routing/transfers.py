@@ -0,0 +1,61 @@
+from os import path
+from numpy import column_stack, concatenate, int64
+from scipy.spatial import cKDTree
+from pandas import DataFrame
+
+from scripts.utils import get_transformer, feed_hash, timetable_cache_folder
+from scripts.routing.timetable_cache import save_timetable, load_timetable, TIMETABLE_FORMAT
+
+# walking speed used for transfers between stops, in metres per second (4 km/h)
+WALK_SPEED = 4 / 3.6
+
+
+# find all pairs of stops within walking distance of each other, like gtfsrouter's gtfs_transfer_table
+# stops are projected to ETRS89 / UTM 32N and paired with a kd-tree, so this stays fast for state sized feeds
+# {args} lon: array, lat: array, d_limit: int, min_transfer_time: int
+# {returns} list of arrays [from stop, to stop, transfer time], stops are given as positions in lon and lat
+def transfer_table(lon, lat, d_limit=200, min_transfer_time=300):
+    x, y = get_transformer(4326, 25832).transform(lon, lat)
+    tree = cKDTree(column_stack([x, y]))
+
+    pairs = tree.query_pairs(d_limit, output_type='ndarray')
+    # query_pairs returns every pair once, transfers are possible in both directions
+    from_stops = concatenate([pairs[:, 0], pairs[:, 1]]).astype(int64)
+    to_stops = concatenate([pairs[:, 1], pairs[:, 0]]).astype(int64)
+
+    distances = ((x[from_stops] - x[to_stops]) ** 2 + (y[from_stops] - y[to_stops]) ** 2) ** 0.5
+    durations = (distances / WALK_SPEED).astype(int64)
+    durations[durations < min_transfer_time] = min_transfer_time
+
+    return [from_stops, to_stops, durations]
+
+
+# get transfer table of a feed from the feed cache, or build and cache it
+# {args} zip_file: str, stops: df of gtfs stops in the order of stops.txt, d_limit: int, min_transfer_time: int
+# {returns} list of arrays [from stop, to stop, transfer time]
+def cached_transfer_table(zip_file, stops, d_limit=200, min_transfer_time=300):
+    feed_name = path.basename(zip_file).rsplit('.', 1)[0]
+    cache_file = path.join(timetable_cache_folder(zip_file), f'{feed_name}_transfers_{d_limit}_{min_transfer_time}_'
+                                                             f'v{TIMETABLE_FORMAT}_{feed_hash(zip_file)}.npz')
+
+    if path.isfile(cache_file):
+        transfers = load_timetable(cache_file)
+    else:
+        from_stops, to_stops, durations = transfer_table(stops['stop_lon'].to_numpy(), stops['stop_lat'].to_numpy(),
+                                                         d_limit, min_transfer_time)
+        transfers = {'from_stop': from_stops, 'to_stop': to_stops, 'duration': durations}
+        save_timetable(transfers, cache_file)
+
+    return [transfers['from_stop'], transfers['to_stop'], transfers['duration']]
+
+
+# get transfer table of a feed in the format of gtfs transfers.txt
+# {args} zip_file: str, stops: df of gtfs stops in the order of stops.txt, d_limit: int, min_transfer_time: int
+# {returns} dataframe
+def transfers_to_df(zip_file, stops, d_limit=200, min_transfer_time=300):
+    from_stops, to_stops, durations = cached_transfer_table(zip_file, stops, d_limit, min_transfer_time)
+    stop_ids = stops['stop_id'].astype(str).to_numpy()
+
+    # transfer_type 2: transfer requires min_transfer_time
+    return DataFrame({'from_stop_id': stop_ids[from_stops], 'to_stop_id': stop_ids[to_stops], 'transfer_type': 2,
+                      'min_transfer_time': durations})
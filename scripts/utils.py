@@ -1,34 +1,152 @@
-from os import path, walk, remove, rmdir
+from os import path, walk, remove, rmdir, replace, getpid, makedirs, stat
+from shutil import rmtree
+from hashlib import sha256
 from zipfile import ZipFile
 from datetime import datetime, timedelta
-from pandas import read_csv, isna, to_datetime
-from geopandas import read_file
-from shapely import LineString
+from numpy import (asarray, char, int32, uint8, where, radians, sin, cos, arcsin, sqrt, column_stack, concatenate,
+                   cumsum, frombuffer, load, savez, save, int64, nan)
+from pandas import read_csv, isna, to_datetime, Series, DataFrame, Categorical, CategoricalDtype, factorize
+from geopandas import read_file, GeoSeries, GeoDataFrame
+from shapely import get_coordinates, transform as transform_coords, to_wkb, from_wkb
 from shapely.ops import transform
 from pyproj import CRS, Transformer
 
+from scripts.constants import AMBIGUOUS_AREAS
+
+# transformers between pairs of epsg codes, created once per process
+TRANSFORMERS = {}
+# administrative areas read in this process by level, with the positions of the areas of each name
+ADMIN_AREAS = {}
+# columns of the administrative areas used by the scripts
+ADMIN_COLUMNS = ['GEN', 'BEZ', 'LAN']
+# hashes of feed zips, keyed by path, modification time and size so unchanged files are only hashed once
+FEED_HASHES = {}
+# gtfs tables of the feed read last in this process, keyed by their folder in the columnar cache
+# a process routes one feed after the other, the tables are shared by all callers and must not be changed
+GTFS_TABLES = {}
+# column types of the gtfs tables, ids repeated in many rows are read as categories
+GTFS_DTYPES = {'agency': {'agency_id': str},
+               'stops': {'stop_id': str, 'stop_name': str, 'stop_lat': 'float32', 'stop_lon': 'float32',
+                         'parent_station': str, 'platform_code': str},
+               'routes': {'route_id': str, 'agency_id': 'category', 'route_short_name': str, 'route_long_name': str},
+               'trips': {'route_id': 'category', 'service_id': 'category', 'trip_id': str, 'trip_headsign': str,
+                         'trip_short_name': str},
+               'stop_times': {'trip_id': 'category', 'stop_id': 'category', 'stop_sequence': 'int32',
+                              'stop_headsign': 'category'},
+               'calendar': {'service_id': str, 'start_date': 'int32', 'end_date': 'int32'},
+               'calendar_dates': {'service_id': 'category', 'date': 'int32'}}
+# gtfs time columns, they are converted to seconds since midnight (int32, -1 if missing)
+GTFS_TIME_COLUMNS = ['arrival_time', 'departure_time']
+
 
 # read shapefile of Germany at given administration level { GEM, KRS, LAN, LI, RBZ, STA, VWG }
+# the shapefile is converted once into an npz archive of its columns and wkb geometries next to it, which is read
+# much faster, and kept in memory for the rest of the process
 # {args} level: str, in_parent_folder: boolean
 # {returns} geodataframe
 def germany_admin(level):
-    shp_path = path.join('data', 'administrative_geographic_data')
+    return load_admin_areas(level)['areas'].copy()
+
+
+# get the areas of an administration level from memory, the npz archive or the shapefile
+# {args} level: str
+# {returns} dict of geodataframe, positions of the areas of each name and the spatial index
+def load_admin_areas(level):
+    if level not in ADMIN_AREAS:
+        shp_path = path.join('data', 'administrative_geographic_data')
+        shp_file = path.join(shp_path, f'VG5000_{level}_wLAN.shp')
+        npz_file = path.join(shp_path, f'VG5000_{level}_wLAN.npz')
+
+        if path.isfile(npz_file) and path.getmtime(npz_file) >= path.getmtime(shp_file):
+            areas = read_admin_npz(npz_file)
+        else:
+            areas = read_file(shp_file)[ADMIN_COLUMNS + ['geometry']]
+            write_admin_npz(areas, npz_file)
+
+        names = {}
+        for position, name in enumerate(areas['GEN']):
+            names.setdefault(name, []).append(position)
+        ADMIN_AREAS[level] = {'areas': areas, 'names': names, 'index': areas.sindex}
+
+    return ADMIN_AREAS[level]
+
+
+# {args} areas: geodataframe, npz_file: str
+# {returns} None, writes file
+def write_admin_npz(areas, npz_file):
+    wkb = to_wkb(asarray(areas.geometry, dtype=object))
+    # wkb of all geometries in one byte buffer, geometry i is buffer[offsets[i]:offsets[i+1]]
+    offsets = concatenate([[0], cumsum([len(geom) for geom in wkb])]).astype(int64)
+    # object arrays would need pickling, store them as fixed width strings instead
+    columns = {column: areas[column].to_numpy() for column in ADMIN_COLUMNS}
+    columns = {column: values.astype(str) if values.dtype == object else values for column, values in columns.items()}
+
+    # write to temporary file first, so other processes never read a half written archive
+    tmp_file = f'{npz_file}.{getpid()}.tmp'
+    with open(tmp_file, 'wb') as archive:
+        savez(archive, wkb=frombuffer(b''.join(wkb), dtype=uint8), offsets=offsets, crs=str(areas.crs.to_wkt()),
+              **columns)
+    replace(tmp_file, npz_file)
+
+
+# {args} npz_file: str
+# {returns} geodataframe
+def read_admin_npz(npz_file):
+    with load(npz_file) as archive:
+        buffer = archive['wkb'].tobytes()
+        offsets = archive['offsets']
+        geometries = from_wkb([buffer[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+        columns = {column: archive[column] for column in ADMIN_COLUMNS}
+        crs = str(archive['crs'])
 
-    geom = read_file(path.join(shp_path, f'VG5000_{level}_wLAN.shp'))
-    return geom[['GEN', 'BEZ', 'LAN', 'geometry']]
+    return GeoDataFrame(columns, geometry=geometries, crs=crs)
+
+
+# get an administrative area by name, for names shared by several areas the one in AMBIGUOUS_AREAS
+# {args} area_name: str, level: str
+# {returns} geodataframe with one row
+def admin_area(area_name, level='GEM'):
+    admin = load_admin_areas(level)
+    if area_name not in admin['names']:
+        raise ValueError(f'there is no area called {area_name} at level {level}')
+
+    positions = admin['names'][area_name]
+    position = positions[AMBIGUOUS_AREAS.get(area_name, 0)]
+    return admin['areas'].iloc[[position]]
+
+
+# get positions of the areas containing each geometry, with the spatial index of the level
+# {args} geometries: GeoSeries, level: str
+# {returns} array [[geometry positions], [area positions]]
+def admin_areas_containing(geometries, level='GEM'):
+    return load_admin_areas(level)['index'].query(asarray(geometries, dtype=object), predicate='within')
+
+
+# {args} current_epsg: int, goal_epsg: int
+# {returns} Transformer
+def get_transformer(current_epsg, goal_epsg):
+    if (current_epsg, goal_epsg) not in TRANSFORMERS:
+        og_crs = CRS(f'EPSG:{current_epsg}')
+        wgs84 = CRS(f'EPSG:{goal_epsg}')
+        TRANSFORMERS[(current_epsg, goal_epsg)] = Transformer.from_crs(og_crs, wgs84, always_xy=True)
+
+    return TRANSFORMERS[(current_epsg, goal_epsg)]
 
 
 # {args} geometries: Series or single geometry, current_epsg: int, goal_epsg: int, single_geom: boolean
 # {returns} Series or single geometry
 def transform_crs(geometries, current_epsg=25832, goal_epsg=4326, single_geom=False):
-    og_crs = CRS(f'EPSG:{current_epsg}')
-    wgs84 = CRS(f'EPSG:{goal_epsg}')
-    project = Transformer.from_crs(og_crs, wgs84, always_xy=True).transform
+    project = get_transformer(current_epsg, goal_epsg).transform
 
     if single_geom:
         return transform(project, geometries)
     else:
-        return geometries.apply(lambda geo: transform(project, geo))
+        # reproject the coordinates of all geometries in one call
+        projected = transform_coords(asarray(geometries, dtype=object),
+                                     lambda coords: column_stack(project(coords[:, 0], coords[:, 1])))
+        if isinstance(geometries, GeoSeries):
+            return GeoSeries(projected, index=geometries.index, crs=geometries.crs)
+        return Series(projected, index=geometries.index)
 
 
 # {args} Polygon
@@ -54,10 +172,8 @@ def get_polygon_bbox(polygon, current_crs=25832, return_string=False):
 # {args} area_name: string
 # {returns} Point
 def centroid_from_name(area_name):
-    districts = germany_admin('GEM')
     # get polygon of area
-    area = districts[districts['GEN'] == area_name]
-    area_polygon = area.geometry.iloc[0]
+    area_polygon = admin_area(area_name).geometry.iloc[0]
 
     return transform_crs(area_polygon.centroid, 25832, 4326, True)
 
@@ -81,19 +197,137 @@ def remove_dir(folder_path):
         rmdir(folder_path)
 
 
+# get content hash of a gtfs zip archive
+# {args} zip_file: str
+# {returns} str
+def feed_hash(zip_file):
+    info = stat(zip_file)
+    key = (zip_file, info.st_mtime_ns, info.st_size)
+    if key not in FEED_HASHES:
+        digest = sha256()
+        with open(zip_file, 'rb') as feed:
+            for chunk in iter(lambda: feed.read(1 << 20), b''):
+                digest.update(chunk)
+        FEED_HASHES[key] = digest.hexdigest()[:16]
+
+    return FEED_HASHES[key]
+
+
+# get folder containing the cached timetables of the feeds in the same folder as zip_file
+# {args} zip_file: str
+# {returns} str
+def timetable_cache_folder(zip_file):
+    return path.join(path.dirname(zip_file), 'timetables')
+
+
 # get dictionary containing gtfs files as dataframes from zip archive
-# {args} input_zip: string
-# {returns} geodataframe
-def zip_to_df(input_zip):
-    gtfs_data = {}
+# tables are only read if they are asked for, from memory, the columnar cache next to the zip archive or the archive
+# the dataframes are shared with other callers (see gtfs_table) and must not be changed in place
+# {args} input_zip: string, tables: [str] or None for all tables in the archive
+# {returns} dict of dataframes
+def zip_to_df(input_zip, tables=None):
+    if tables is None:
+        with ZipFile(input_zip, 'r') as zip_ref:
+            tables = [file_name[:-4] for file_name in zip_ref.namelist() if file_name.lower().endswith('.txt')]
+
+    return {table: gtfs_table(input_zip, table) for table in tables}
+
+
+# get one table of a gtfs feed, parsing it only the first time it is read
+# the dataframe is kept in memory and returned to every caller, it is read-only, copy it before changing it
+# {args} input_zip: str, table: str
+# {returns} dataframe
+def gtfs_table(input_zip, table):
+    feed_folder = path.join(timetable_cache_folder(input_zip),
+                            f'{path.basename(input_zip).rsplit(".", 1)[0]}_tables_{feed_hash(input_zip)}')
+    table_folder = path.join(feed_folder, table)
+    if table_folder not in GTFS_TABLES:
+        # only the tables of the current feed are kept alive
+        for other in [key for key in GTFS_TABLES if path.dirname(key) != feed_folder]:
+            del GTFS_TABLES[other]
+        if path.isdir(table_folder):
+            GTFS_TABLES[table_folder] = read_table_columns(table_folder)
+        else:
+            df = read_gtfs_table(input_zip, table)
+            write_table_columns(df, table_folder)
+            GTFS_TABLES[table_folder] = df
 
+    return GTFS_TABLES[table_folder]
+
+
+# parse a gtfs table from the zip archive with compact column types, times are converted to seconds
+# {args} input_zip: str, table: str
+# {returns} dataframe
+def read_gtfs_table(input_zip, table):
     with ZipFile(input_zip, 'r') as zip_ref:
-        for file_name in zip_ref.namelist():
-            if file_name.lower().endswith('.txt'):
-                df = read_csv(zip_ref.open(file_name), encoding='utf-8')
-                gtfs_data[file_name[:-4]] = df  # Remove the '.txt' extension
+        file_name = [name for name in zip_ref.namelist() if name.lower() == f'{table}.txt'.lower()][0]
+        with zip_ref.open(file_name) as table_file:
+            columns = read_csv(table_file, encoding='utf-8', nrows=0).columns
+        dtypes = {column: dtype for column, dtype in GTFS_DTYPES.get(table, {}).items() if column in columns}
+        dtypes.update({column: str for column in GTFS_TIME_COLUMNS if column in columns})
+        with zip_ref.open(file_name) as table_file:
+            df = read_csv(table_file, encoding='utf-8', dtype=dtypes)
+
+    for column in GTFS_TIME_COLUMNS:
+        if column in df.columns:
+            df[column] = gtfs_time_to_seconds(df[column])
+
+    return df
+
+
+# write the columns of a table as numpy arrays, strings are written as codes and unique values
+# {args} df: dataframe, table_folder: str
+# {returns} None, writes folder
+def write_table_columns(df, table_folder):
+    # write to temporary folder first, so other processes never read a half written table
+    tmp_folder = f'{table_folder}.{getpid()}.tmp'
+    makedirs(tmp_folder, exist_ok=True)
+
+    kinds = []
+    for cid, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, CategoricalDtype):
+            kinds.append('category')
+            save(path.join(tmp_folder, f'{cid}.codes.npy'), values.cat.codes.to_numpy().astype(int32))
+            save(path.join(tmp_folder, f'{cid}.values.npy'), values.cat.categories.to_numpy().astype(str))
+        elif values.dtype.kind in 'biuf':
+            kinds.append('number')
+            save(path.join(tmp_folder, f'{cid}.npy'), values.to_numpy())
+        else:
+            kinds.append('text')
+            codes, uniques = factorize(values)
+            save(path.join(tmp_folder, f'{cid}.codes.npy'), codes.astype(int32))
+            save(path.join(tmp_folder, f'{cid}.values.npy'), asarray(uniques).astype(str))
+    save(path.join(tmp_folder, 'columns.npy'), asarray(df.columns).astype(str))
+    save(path.join(tmp_folder, 'kinds.npy'), asarray(kinds))
+
+    try:
+        replace(tmp_folder, table_folder)
+    except OSError:
+        # another process has written the table in the meantime
+        rmtree(tmp_folder)
+
 
-    return gtfs_data
+# read a table written by write_table_columns, number columns are memory mapped
+# {args} table_folder: str
+# {returns} dataframe
+def read_table_columns(table_folder):
+    columns = {}
+    kinds = load(path.join(table_folder, 'kinds.npy'))
+    for cid, column in enumerate(load(path.join(table_folder, 'columns.npy')).tolist()):
+        if kinds[cid] == 'number':
+            columns[column] = load(path.join(table_folder, f'{cid}.npy'), mmap_mode='r')
+            continue
+
+        codes = load(path.join(table_folder, f'{cid}.codes.npy'), mmap_mode='r')
+        values = load(path.join(table_folder, f'{cid}.values.npy')).astype(object)
+        if kinds[cid] == 'category':
+            columns[column] = Categorical.from_codes(codes, categories=values)
+        else:
+            # code -1 marks missing values, it takes the nan appended to the values
+            columns[column] = concatenate([values, asarray([nan], dtype=object)])[codes]
+
+    return DataFrame(columns)
 
 
 # convert gtfs time (exceeds 24:00:00) to pandas datetime format
@@ -110,19 +344,59 @@ def gtfs_time_to_pandas_datetime(gtfs_date, gtfs_time):
         return to_datetime(date_time)
 
 
+# convert gtfs times (may exceed 24:00:00) to seconds since the start of the service day in one pass
+# missing and empty times (stops between timepoints may have no times) are returned as -1
+# {args} gtfs_times: series, array or list of str
+# {returns} array of int32
+def gtfs_time_to_seconds(gtfs_times):
+    # times already converted when the feed was read
+    if asarray(gtfs_times).dtype.kind in 'iu':
+        return asarray(gtfs_times).astype(int32)
+
+    values = asarray(gtfs_times, dtype=object)
+    if len(values) == 0:
+        return values.astype(int32)
+
+    # pad times like 7:05:00 to 07:05:00 and read the digits from the raw bytes
+    values = char.strip(where(isna(values), '', values).astype(str))
+    missing = char.str_len(values) == 0
+    text = char.zfill(where(missing, '00:00:00', values).astype('U8'), 8).astype('S8')
+    digits = text.view(uint8).reshape(-1, 8).astype(int32) - ord('0')
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+               + digits[:, 6] * 10 + digits[:, 7])
+    seconds[missing] = -1
+
+    return seconds
+
+
+# great circle distance in metres between coordinates in degrees
+# {args} lon1: float or array, lat1: float or array, lon2: float or array, lat2: float or array
+# {returns} float or array
+def haversine_distance(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(radians, (lon1, lat1, lon2, lat2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * 6371000 * arcsin(sqrt(a))
+
+
 # {args} point: point object, dataframe: dataframe with geometry column of cinema centroid points
 # {returns} list of cinema names list and list of corresponding distances to given point
 def calc_distance(point, goal, single_point=False):
     if single_point:
-        line = LineString([point, goal])
-        line2 = transform_crs(line, 4326, 25832, True)
-        return line2.length
+        return float(calc_distance_matrix([point], [goal])[0, 0])
     else:
-        name = []
-        dist = []
-        for rid, row in goal.iterrows():
-            line = LineString([point, row['geometry']])
-            line2 = transform_crs(line, 4326, 25832, True)
-            name.append(row['name'])
-            dist.append(line2.length)
-        return [name, dist]
+        return [list(goal['name']), calc_distance_matrix([point], goal['geometry'])[0].tolist()]
+
+
+# straight line distances in metres between all points and all goals, projected to ETRS89 / UTM 32N all at once
+# {args} points: GeoSeries or [Point], goals: GeoSeries or [Point]
+# {returns} array (points x goals)
+def calc_distance_matrix(points, goals):
+    project = get_transformer(4326, 25832).transform
+    point_coords = get_coordinates(asarray(points, dtype=object)).reshape(-1, 2)
+    goal_coords = get_coordinates(asarray(goals, dtype=object)).reshape(-1, 2)
+    point_x, point_y = project(point_coords[:, 0], point_coords[:, 1])
+    goal_x, goal_y = project(goal_coords[:, 0], goal_coords[:, 1])
+
+    return sqrt((asarray(point_x)[:, None] - asarray(goal_x)[None, :]) ** 2 +
+                (asarray(point_y)[:, None] - asarray(goal_y)[None, :]) ** 2)
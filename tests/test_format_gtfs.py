@@ -0,0 +1,22 @@
+from io import BytesIO
+from zipfile import ZipFile
+from pandas import read_csv
+
+from scripts.data_pre_processing.format_gtfs import write_cleaned_file
+
+
+def test_empty_stop_times_survive_cleaning():
+    stop_times = (b'trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type\n'
+                  b't1,08:00:00,08:00:00,a,1,\n'
+                  b't1,,,b,2,\n'
+                  b't1,08:10:00,08:10:00,c,3,1\n')
+    archive = BytesIO()
+    with ZipFile(archive, 'w') as zipf:
+        write_cleaned_file(BytesIO(stop_times), 'stop_times.txt', zipf)
+    with ZipFile(archive) as zipf:
+        cleaned = read_csv(zipf.open('stop_times.txt'), dtype=str, keep_default_na=False)
+
+    # stops between timepoints keep empty times, other missing values are still filled
+    assert cleaned['arrival_time'].tolist() == ['08:00:00', '', '08:10:00']
+    assert cleaned['departure_time'].tolist() == ['08:00:00', '', '08:10:00']
+    assert cleaned['pickup_type'].tolist() == ['0', '0', '1']
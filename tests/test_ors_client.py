@@ -0,0 +1,163 @@
+import json
+from threading import Thread, Lock
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from openrouteservice import exceptions
+
+import scripts.routing.ors_client as ors_client
+import scripts.routing.ors_routing as ors_routing
+import scripts.routing.duration_cache as duration_cache
+
+
+# local ors stub: answers with the queued (status, ors error code) first, then with the (status, code) of the
+# destination longitude of a directions request in errors, else with durations
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.ports.add(self.client_address[1])
+            status, code = server.statuses.pop(0) if server.statuses else \
+                server.errors.get(body.get('coordinates', [[], [None]])[1][0], (200, None))
+        sleep(server.delay)
+
+        if status != 200:
+            answer = {'error': {'code': code, 'message': 'ors error'}}
+        elif '/matrix/' in self.path:
+            answer = {'durations': [[float(source * 100 + destination) for destination in body['destinations']]
+                                    for source in body['sources']]}
+        else:
+            answer = {'routes': [{'summary': {'duration': 60.0}}]}
+        data = json.dumps(answer).encode()
+        with server.lock:
+            server.active -= 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock, server.statuses, server.errors, server.delay = Lock(), [], {}, 0
+    server.requests, server.active, server.max_active, server.ports = 0, 0, 0, set()
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    waits = []
+    monkeypatch.setattr(ors_client, 'ORS_URL', f'http://127.0.0.1:{server.server_address[1]}')
+    monkeypatch.setattr(ors_client, 'sleep', waits.append)
+    monkeypatch.setitem(ors_client.ORS, 'client', None)
+    server.waits = waits
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('status', [500, 502, 429])
+def test_transient_errors_are_retried(stub, status):
+    stub.statuses = [(status, None), (status, None)]
+    response = ors_client.ors_directions(((7.0, 52.0), (7.1, 52.1)), 'foot-walking')
+
+    assert response['routes'][0]['summary']['duration'] == 60
+    assert stub.requests == 3
+    assert len(stub.waits) == 2
+
+
+def test_unroutable_request_is_not_retried(stub):
+    stub.statuses = [(404, 2010)]
+    with pytest.raises(exceptions.ApiError) as err:
+        ors_client.ors_directions(((7.0, 52.0), (7.1, 52.1)), 'foot-walking')
+
+    assert err.value.status == 404
+    assert stub.requests == 1
+    assert stub.waits == []
+
+
+def test_backoff_doubles_until_retries_run_out(stub):
+    stub.statuses = [(500, None)] * (ors_client.ORS_RETRIES + 1)
+    with pytest.raises(exceptions.ApiError):
+        ors_client.ors_directions(((7.0, 52.0), (7.1, 52.1)), 'foot-walking')
+
+    assert stub.requests == ors_client.ORS_RETRIES + 1
+    assert len(stub.waits) == ors_client.ORS_RETRIES
+    for attempt, wait in enumerate(stub.waits):
+        base = ors_client.ORS_BACKOFF * 2 ** attempt
+        assert 0.5 * base <= wait <= 1.5 * base
+
+
+def test_matrix_blocks_are_requested_concurrently(stub, monkeypatch):
+    monkeypatch.setattr(ors_routing, 'MATRIX_MAX_ROUTES', 4)
+    stub.delay = 0.2
+    starts = [(7.0 + i / 100, 52.0) for i in range(16)]
+    ends = [(8.0 + j / 100, 52.0) for j in range(4)]
+    durations, failed = ors_routing.request_ors_matrix(starts, ends, 'foot-walking')
+
+    # one block per start, the sources of each block are numbered from 0
+    assert stub.requests == 16
+    assert failed == set()
+    assert [[duration.total_seconds() for duration in row] for row in durations] == [[1, 2, 3, 4]] * 16
+    assert 1 < stub.max_active <= ors_client.ORS_CONCURRENCY
+    # the connections of the shared session are kept alive between requests
+    assert len(stub.ports) <= ors_client.ORS_CONCURRENCY
+
+
+def use_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(duration_cache, 'RESULTS_PATH', str(tmp_path))
+    monkeypatch.setitem(duration_cache.DURATION_CACHE, 'store', None)
+    monkeypatch.setitem(duration_cache.DURATION_CACHE, 'used', set())
+
+
+def test_only_unroutable_trips_are_cached_as_none(stub, monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path)
+    start, ends = (7.0, 52.0), [(8.0, 52.0), (8.1, 52.0), (8.2, 52.0)]
+    # the matrix request is rejected, then the first trip has no route and the second one exceeds a limit of ors
+    stub.statuses = [(400, 2004)]
+    stub.errors = {8.0: (404, 2010), 8.1: (400, 2004)}
+    durations = ors_routing.get_ors_matrix([start], ends, 'foot-walking')
+
+    assert durations[0][:2] == [None, None]
+    assert durations[0][2].total_seconds() == 60
+    keys = [duration_cache.duration_key(start, end, 'foot-walking') for end in ends]
+    assert duration_cache.get_cached_durations(keys) == {keys[0]: None, keys[2]: durations[0][2]}
+    duration_cache.DURATION_CACHE['store'].close()
+
+
+def test_bulk_jobs_are_requested_concurrently_and_cached(stub, monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path)
+    stub.delay = 0.1
+    stub.errors = {8.5: (400, 2004)}
+    jobs = [((7.0, 52.0), (8.0 + j / 10, 52.0), 'foot-walking') for j in range(12)]
+    durations = ors_routing.get_ors_durations_bulk(jobs + jobs[:2], concurrency=3)
+
+    assert stub.requests == 12
+    assert stub.max_active == 3
+    assert durations[5] is None
+    assert [duration.total_seconds() for jid, duration in enumerate(durations) if jid != 5] == [60] * 13
+
+    # only the rejected trip is requested again
+    ors_routing.get_ors_durations_bulk(jobs, concurrency=3)
+    assert stub.requests == 13
+    duration_cache.DURATION_CACHE['store'].close()
+
+
+def test_directions_fallback_is_requested_concurrently(stub):
+    stub.delay = 0.1
+    stub.statuses = [(400, 2004)]
+    ends = [(8.0 + j / 100, 52.0) for j in range(8)]
+    durations, failed = ors_routing.request_ors_matrix([(7.0, 52.0)], ends, 'foot-walking', concurrency=4)
+
+    assert stub.requests == 9
+    assert stub.max_active == 4
+    assert failed == set()
+    assert [duration.total_seconds() for duration in durations[0]] == [60] * 8
@@ -0,0 +1,17 @@
+from numpy import array, isinf
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from scripts.routing.osm_routing import bounded_dijkstra
+
+
+def test_bounded_search_finds_far_and_misses_unreachable_targets():
+    # nodes 100 m apart on a line, the edge to node 3 takes an hour, node 4 cannot be reached
+    graph = {'lon': array([11.0, 11.0015, 11.003, 11.0045, 11.006]), 'lat': array([54.0] * 5)}
+    matrix = csr_matrix((array([72.0, 72.0, 3600.0]), (array([0, 1, 2]), array([1, 2, 3]))), shape=(5, 5))
+
+    seconds = bounded_dijkstra(graph, matrix, array([0]), array([1, 3, 4]), 'foot-walking')
+
+    assert seconds[0, :2].tolist() == [72.0, 3744.0]
+    assert isinf(seconds[0, 2])
+    assert seconds.tolist() == dijkstra(matrix, indices=[0])[:, [1, 3, 4]].tolist()
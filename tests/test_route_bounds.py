@@ -0,0 +1,108 @@
+from os import path
+from zipfile import ZipFile
+from numpy import argsort
+from pandas import Timedelta
+from shapely import Point
+
+from scripts.utils import zip_to_df, haversine_distance, gtfs_time_to_seconds
+from scripts.routing.csa_routing import csa_timetable, csa_route_many
+from scripts.routing.route_bounds import network_max_speed, duration_lower_bounds, WALK_SPEED_BOUND, \
+    MAX_TRANSIT_SPEED
+
+FEED = path.join(path.dirname(__file__), '..', 'data', 'gtfs_files', 'Kühlungsborn_opnv_240218_filtered.zip')
+
+
+# closest stops with distinct names, like get_osm_data.get_stations
+def closest_stations(stops, point, number=10):
+    distance = haversine_distance(point.x, point.y, stops['stop_lon'].to_numpy(dtype=float),
+                                  stops['stop_lat'].to_numpy(dtype=float))
+    return stops.iloc[argsort(distance, kind='stable')].drop_duplicates('stop_name').iloc[:number]
+
+
+# total duration of a route with straight line walks to its first and from its last stop
+def total_duration(route, stops, start_point, cinema_location):
+    coords = stops.drop_duplicates('stop_id').set_index('stop_id')
+    first = coords.loc[route['stop_id'].iloc[0]]
+    last = coords.loc[route['stop_id'].iloc[-1]]
+    times = gtfs_time_to_seconds([route['departure_time'].iloc[0], route['arrival_time'].iloc[-1]])
+    walk_to = haversine_distance(start_point.x, start_point.y, float(first['stop_lon']), float(first['stop_lat']))
+    walk_from = haversine_distance(float(last['stop_lon']), float(last['stop_lat']), cinema_location.x,
+                                   cinema_location.y)
+    return (walk_to + walk_from) / WALK_SPEED_BOUND + times[1] - times[0]
+
+
+def test_network_max_speed_ignores_misplaced_stop():
+    # the misplaced stop 'Sabel (b Güstrow) Haus 24' gives hop speeds of more than 600 m/s
+    speed = network_max_speed(FEED)
+    assert 10 < speed < 50
+    assert speed <= MAX_TRANSIT_SPEED
+
+
+# fastest total duration over all start stations, and with the pruning loop of gtfs_routing.get_fastest_route
+# stops are routed by ascending bound until no bound beats the fastest route
+def fastest_with_pruning(feed, start_point, cinema_location, start_time):
+    stops = zip_to_df(feed, ['stops'])['stops']
+    timetable = csa_timetable(feed, 'Sat')
+    start = closest_stations(stops, start_point)
+    end = closest_stations(stops, cinema_location)
+
+    totals = []
+    for start_name in start['stop_name']:
+        routes = csa_route_many(timetable, start_name, end['stop_name'].tolist(), start_time)
+        durations = [total_duration(route, stops, start_point, cinema_location) for route in routes
+                     if route is not None]
+        totals.append(min(durations) if durations else None)
+    fastest = min(total for total in totals if total is not None)
+
+    bounds = duration_lower_bounds(start, start_point, end, cinema_location, network_max_speed(feed))
+    pruned_fastest = Timedelta('1 day').total_seconds()
+    skipped = 0
+    order = bounds.argsort(kind='stable')
+    for rank, sid in enumerate(order):
+        if bounds[sid] >= pruned_fastest:
+            skipped = len(order) - rank
+            break
+        if totals[sid] is not None:
+            pruned_fastest = min(pruned_fastest, totals[sid])
+
+    return [fastest, pruned_fastest, skipped]
+
+
+# write a feed of stops on the 54th parallel, x in km east of 11°E, and trips of [(stop_id, gtfs time)]
+def write_line_feed(zip_file, stops, trips):
+    with ZipFile(zip_file, 'w') as zipf:
+        zipf.writestr('stops.txt', 'stop_id,stop_name,stop_lat,stop_lon\n' +
+                      ''.join(f'{sid},{sid},54.0,{11 + x / 65.43}\n' for sid, x in stops.items()))
+        zipf.writestr('calendar.txt', 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,'
+                                      'start_date,end_date\ns,1,1,1,1,1,1,1,20240101,20241231\n')
+        zipf.writestr('routes.txt', 'route_id,route_short_name,route_type\nr,1,3\n')
+        zipf.writestr('trips.txt', 'route_id,service_id,trip_id\n' +
+                      ''.join(f'r,s,t{tid}\n' for tid in range(len(trips))))
+        zipf.writestr('stop_times.txt', 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n' +
+                      ''.join(f't{tid},{time},{time},{sid},{seq}\n' for tid, trip in enumerate(trips)
+                              for seq, (sid, time) in enumerate(trip)))
+
+
+def test_pruning_skips_stops_and_keeps_fastest_route():
+    # start in Rerik, cinema in Kühlungsborn, the start stations are spread along the coast
+    fastest, pruned_fastest, skipped = fastest_with_pruning(FEED, Point(11.6200, 54.1060), Point(11.7545, 54.1428),
+                                                            15 * 3600)
+
+    assert skipped > 0
+    assert pruned_fastest == fastest
+
+
+def test_pruning_keeps_route_of_one_fast_hop(tmp_path):
+    # 150 buses ride 20 km in 2500 s from the closest stop, one express rides them in 600 s from a stop further away
+    feed = str(tmp_path / 'line.zip')
+    stops = {'bus_start': 0.1, 'express_start': -0.4, 'bus_end': 20, 'express_end': 20.05}
+    buses = [[('bus_start', f'15:{minute:02d}:00'), ('bus_end', f'15:{minute + 41:02d}:40')] for minute in range(15)]
+    buses = buses * 10
+    write_line_feed(feed, stops, buses + [[('express_start', '15:05:00'), ('express_end', '15:15:00')]])
+    fastest, pruned_fastest, skipped = fastest_with_pruning(feed, Point(11, 54.0), Point(11 + 20.1 / 65.43, 54.0),
+                                                            15 * 3600)
+
+    # the bound of the express stop is below the bus route only at the speed of the express
+    assert network_max_speed(feed) > 30
+    assert fastest < 1200
+    assert pruned_fastest == fastest
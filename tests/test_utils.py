@@ -0,0 +1,24 @@
+from zipfile import ZipFile
+from numpy import nan
+
+from scripts.utils import gtfs_time_to_seconds, zip_to_df, GTFS_TABLES
+
+
+def test_empty_gtfs_times_are_missing():
+    # stops between timepoints may have empty times, they must not become midnight
+    seconds = gtfs_time_to_seconds(['7:05:00', '', ' ', None, nan, '25:00:01'])
+    assert seconds.tolist() == [25500, -1, -1, -1, -1, 90001]
+
+
+def test_only_tables_of_last_feed_are_kept(tmp_path):
+    for name in ['first', 'second']:
+        with ZipFile(tmp_path / f'{name}.zip', 'w') as zipf:
+            zipf.writestr('stops.txt', f'stop_id,stop_name,stop_lat,stop_lon\n1,{name},54.0,11.0\n')
+
+    first = zip_to_df(str(tmp_path / 'first.zip'), ['stops'])['stops']
+    assert zip_to_df(str(tmp_path / 'first.zip'), ['stops'])['stops'] is first
+    second = zip_to_df(str(tmp_path / 'second.zip'), ['stops'])['stops']
+
+    assert second['stop_name'].tolist() == ['second']
+    assert len(GTFS_TABLES) == 1
+    assert zip_to_df(str(tmp_path / 'first.zip'), ['stops'])['stops']['stop_name'].tolist() == ['first']